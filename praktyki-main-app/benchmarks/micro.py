@@ -0,0 +1,128 @@
+"""
+Microbenchmarks of code run by the application in process, without HTTP and the server in the way:
+verification of login tokens (RS256 signature check, and answer from cache of verified tokens), routing
+of plain and parametrized paths, whole WSGI call of the cheapest route, and WriteBuffer with different
+batch sizes.
+
+Usage:  python -m benchmarks.micro [--mongo-uri URI] [--number N] [--batch-sizes 1 10 100 1000]
+
+Token scenarios need keys in .ssh/, they are skipped without them. With the in-memory database
+(default) WriteBuffer has no network round trip to save, so the gain of bigger batches is much lower
+than against MongoDB server - pass --mongo-uri of one for numbers that mean something
+"""
+from __future__ import annotations
+import argparse
+import io
+import math
+import os
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(function: callable, number: int) -> dict:
+    """
+    Calls function number times
+    @return: summary with calls per second and p50/p99 of single call in microseconds
+    """
+    latencies = []
+    for _ in range(number):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "ops": round(number / sum(latencies), 1),
+        "p50_us": round(latencies[len(latencies) // 2] * 1e6, 2),
+        "p99_us": round(latencies[max(0, math.ceil(0.99 * len(latencies)) - 1)] * 1e6, 2),
+    }
+
+
+def auth_benchmarks(number: int) -> dict:
+    from source.auth import Auth
+    auth = Auth()
+    if not (os.path.exists(Auth.keys.public_path) and os.path.exists(Auth.keys.private_path)):
+        print("Skipping token benchmarks, there are no keys in .ssh/")
+        return {}
+    # every verified token is cached, cold verification needs a new token for every call
+    tokens = iter([auth.generate_login_token(f"bench{index}") for index in range(number)])
+    warm = auth.generate_login_token("bench")
+    auth.authenticate(warm)
+    return {
+        "generate_token": measure(lambda: auth.generate_login_token("bench"), number),
+        "authenticate_cold": measure(lambda: auth.authenticate(next(tokens)), number),
+        "authenticate_cached": measure(lambda: auth.authenticate(warm), number),
+    }
+
+
+def dispatch_benchmarks(number: int) -> dict:
+    from source.app import application, router
+
+    def call_index():
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/", "QUERY_STRING": "", "REMOTE_ADDR": "127.0.0.1",
+                   "wsgi.input": io.BytesIO()}
+        b"".join(application(environ, lambda status, headers, exc_info=None: None))
+
+    return {
+        "resolve_plain": measure(lambda: router.resolve("/get_articles", "GET"), number),
+        "resolve_param": measure(lambda: router.resolve("/users/bench/articles", "GET"), number),
+        "route_name_unknown": measure(lambda: router.route_name("/no/such/path"), number),
+        "wsgi_index": measure(call_index, number),
+    }
+
+
+def write_buffer_benchmarks(number: int, batch_sizes: list[int]) -> dict:
+    """
+    Inserts number objects through WriteBuffer for every batch size and waits for all of them to be written
+    """
+    from source.database import Database, WriteBuffer
+    from source.utils import WRITE_BUFFER_INTERVAL
+    database = Database.shared().database
+    results = {}
+    for batch_size in batch_sizes:
+        collection = database.get_collection(f"benchmark_buffer_{batch_size}")
+        collection.drop()
+        write_buffer = WriteBuffer(collection, batch_size, WRITE_BUFFER_INTERVAL)
+        start = time.perf_counter()
+        futures = [write_buffer.insert({"number": index}) for index in range(number)]
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - start
+        write_buffer.close()
+        collection.drop()
+        results[f"write_buffer_{batch_size}"] = {"ops": round(number / elapsed, 1),
+                                                 "batches": math.ceil(number / batch_size)}
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Microbenchmarks of authentication, routing and write buffer")
+    parser.add_argument("--mongo-uri", default="mongomock://", help="MONGO_URI used by write buffer benchmark")
+    parser.add_argument("--number", type=int, default=1000, help="calls of every benchmarked function")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100, 1000],
+                        help="batch sizes of write buffer")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    # settings are read when the application is imported, keys are looked up relative to the application
+    os.environ.update(MONGO_URI=args.mongo_uri, RATE_LIMIT="0", LOG_SUCCESS_SAMPLE_RATE="0")
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+
+    results = {}
+    results.update(auth_benchmarks(args.number))
+    results.update(dispatch_benchmarks(args.number))
+    results.update(write_buffer_benchmarks(args.number, args.batch_sizes))
+
+    print(f"{'benchmark':<24}{'ops/s':>12}{'p50 us':>10}{'p99 us':>10}{'batches':>9}")
+    for name, result in results.items():
+        print(f"{name:<24}{result['ops']:>12}{result.get('p50_us', '-'):>10}{result.get('p99_us', '-'):>10}"
+              f"{result.get('batches', '-'):>9}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
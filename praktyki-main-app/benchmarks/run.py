@@ -0,0 +1,413 @@
+"""
+Load test of the application. Seeds fixed-size data set, drives every route with concurrent clients
+and reports per endpoint throughput, p50/p95/p99 latency, p50/p95 time to first byte, mean bytes
+of response and peak memory (RSS) of the server processes. Results are compared with stored baseline,
+the run fails when any endpoint got slower than the baseline allows.
+
+Usage:  python -m benchmarks.run [--target URL] [--clients N] [--duration SECONDS] [--update-baseline]
+                                 [--modes threaded prefork asgi] [--workers 1 2 4] [--cpus 1 2]
+
+Without --target the server is started by the benchmark with in-memory database (MONGO_URI=mongomock://,
+requires mongomock), so it runs without access to the Atlas cluster. Every combination of --modes,
+--workers and --cpus (server pinned to that many cores) is started and measured separately, so worker
+and core scaling and server modes can be compared. Routes requiring login are skipped if the server
+has no keys in .ssh/. Code run inside a request (token verification, routing, write buffer batch sizes)
+is measured without HTTP by benchmarks.micro.
+
+Not measured with the in-memory database - pass --mongo-uri of MongoDB server for them:
+- search_articles, in-memory database has no $text search
+- more than one worker, every worker process would have its own in-memory database
+"""
+from __future__ import annotations
+import argparse
+import http.client
+import importlib.util
+import itertools
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+from urllib import parse
+
+from benchmarks.scenarios import SCENARIOS, Context, Scenario
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(APP_DIR, "benchmarks", "baseline.json")
+SERVER_LOG_PATH = os.path.join(APP_DIR, "benchmarks", "server.log")
+SEED_CHUNK = 10000  # documents inserted by one seeding request, SEED_MAX_COUNT of the application
+
+
+class Client:
+    """
+    HTTP client of one benchmark thread. Server may close the connection after every response,
+    so connection is reopened when needed
+    """
+    def __init__(self, target: str):
+        url = parse.urlsplit(target)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self._connection = None
+
+    def request(self, method: str, path: str, body: dict | None = None,
+                headers: dict | None = None) -> (int, bytes, float):
+        """
+        @return: tuple of status, body of response, and perf_counter() time when headers of response arrived
+        """
+        data = json.dumps(body).encode() if body is not None else None
+        headers = dict(headers or {})
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+        for attempt in range(2):
+            if self._connection is None:
+                self._connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self._connection.request(method, path, body=data, headers=headers)
+                response = self._connection.getresponse()
+                first_byte = time.perf_counter()
+                content = response.read()
+                if response.will_close:
+                    self.close()
+                return response.status, content, first_byte
+            except (ConnectionError, http.client.HTTPException):
+                # connection closed by server between requests, repeated once on a new one
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def start_server(port: int, mongo_uri: str, mode: str, workers: int, threads: int,
+                 cpus: int | None) -> subprocess.Popen:
+    """
+    Starts the application in a separate process, so clients do not compete with it for the GIL.
+    Output of the server goes to SERVER_LOG_PATH
+    @param cpus: number of cores the server and its workers are pinned to, None for all of them
+    """
+    env = dict(os.environ, MONGO_URI=mongo_uri, SEED_RANDOM=os.environ.get("SEED_RANDOM", "2024"),
+               LOG_SUCCESS_SAMPLE_RATE="0", RATE_LIMIT="0")
+    pin = (lambda: os.sched_setaffinity(0, range(cpus))) if cpus else None
+    with open(SERVER_LOG_PATH, "a") as log:
+        return subprocess.Popen([sys.executable, "server.py", "--mode", mode, "--host", "127.0.0.1",
+                                 "--port", str(port), "--workers", str(workers), "--threads", str(threads)],
+                                cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT, preexec_fn=pin)
+
+
+def process_tree_rss(pid: int) -> int | None:
+    """
+    Resident memory of the process and all its descendants (prefork and uvicorn workers), read from /proc
+    @return: memory in bytes, None where /proc is not available
+    """
+    if not os.path.exists(f"/proc/{pid}/status"):
+        return None
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as file:
+                    # process name in parentheses can contain spaces, parent pid is the second field after it
+                    parents[int(entry)] = int(file.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+    tree = {pid}
+    changed = True
+    while changed:
+        children = {child for child, parent in parents.items() if parent in tree} - tree
+        tree |= children
+        changed = bool(children)
+    rss = 0
+    for member in tree:
+        try:
+            with open(f"/proc/{member}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return rss
+
+
+def wait_ready(target: str, server: subprocess.Popen | None, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    client = Client(target)
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}, see {SERVER_LOG_PATH}")
+        try:
+            status, _, _ = client.request("GET", "/health")
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {target} is not ready after {timeout} seconds")
+
+
+def seed(target: str, users: int, articles: int, comments: int) -> None:
+    client = Client(target)
+    for path, count in (("/insert_random_user", users), ("/insert_random_art", articles),
+                        ("/insert_random_comment", comments)):
+        while count > 0:
+            chunk = min(count, SEED_CHUNK)
+            status, content, _ = client.request("POST", f"{path}?count={chunk}")
+            if status != 201:
+                raise RuntimeError(f"Seeding with {path} failed: {status} {content[:200]!r}")
+            count -= chunk
+
+
+def prepare(target: str) -> Context:
+    """
+    Registers benchmark user, logs it in and collects ids of articles to read and comment
+    """
+    client = Client(target)
+    suffix = f"{os.getpid()}{int(time.time())}"
+    username, email, password = f"benchuser{suffix}", f"benchuser{suffix}@bench.pl", "benchmark-password"
+    status, content, _ = client.request("POST", "/register",
+                                        {"username": username, "email": email, "password": password})
+    if status != 201:
+        raise RuntimeError(f"Registration of benchmark user failed: {status} {content[:200]!r}")
+    status, content, _ = client.request("POST", "/login", {"login_str": username, "password": password})
+    token = content.decode() if status == 200 else None
+
+    status, content, _ = client.request("GET", "/get_articles_textless?limit=500",
+                                        headers={"Accept": "application/json"})
+    if status != 200:
+        raise RuntimeError(f"Listing articles failed: {status} {content[:200]!r}")
+    articles = json.loads(content)["items"]
+    if not articles:
+        raise RuntimeError("There are no articles, seed the database first")
+    article_ids = [article["_id"]["$oid"] for article in articles]
+    authors = sorted({article["author"]["username"] for article in articles})
+    return Context(article_ids, authors, username, password, email, token)
+
+
+def percentile(latencies: list[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of sorted latencies
+    """
+    return latencies[max(0, math.ceil(fraction * len(latencies)) - 1)]
+
+
+def run_scenario(target: str, scenario: Scenario, context: Context, clients: int, duration: float,
+                 server_pid: int | None = None) -> dict:
+    """
+    Sends requests of the scenario from clients threads for duration seconds
+    @param server_pid: process of the server whose memory is sampled while the scenario runs
+    @return: summary with number of requests and errors, throughput in requests/s, latencies and time to first
+             byte in ms, mean size of response body in bytes and peak memory of the server in MB
+    """
+    latencies = []
+    first_bytes = []
+    sizes = []
+    errors = {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def work():
+        client = Client(target)
+        local_latencies = []
+        local_first_bytes = []
+        local_sizes = []
+        local_errors = {}
+        while time.monotonic() < deadline:
+            path, body, headers = scenario.build(context)
+            start = time.perf_counter()
+            try:
+                status, content, first_byte = client.request(scenario.method, path, body, headers)
+                local_first_bytes.append(first_byte - start)
+                local_sizes.append(len(content))
+            except OSError as error:
+                status = type(error).__name__
+            local_latencies.append(time.perf_counter() - start)
+            if status not in scenario.expected:
+                local_errors[status] = local_errors.get(status, 0) + 1
+        client.close()
+        with lock:
+            latencies.extend(local_latencies)
+            first_bytes.extend(local_first_bytes)
+            sizes.extend(local_sizes)
+            for status, count in local_errors.items():
+                errors[status] = errors.get(status, 0) + count
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=work) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    peak_rss = None
+    while any(thread.is_alive() for thread in threads):
+        if server_pid is not None:
+            rss = process_tree_rss(server_pid)
+            peak_rss = max(peak_rss or 0, rss) if rss is not None else peak_rss
+        threads[0].join(0.1)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    first_bytes.sort()
+    summary = {"requests": len(latencies), "errors": sum(errors.values()),
+               "throughput": round(len(latencies) / elapsed, 1)}
+    for name, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+        summary[name] = round(percentile(latencies, fraction) * 1000, 2) if latencies else None
+    for name, fraction in (("ttfb_p50", 0.50), ("ttfb_p95", 0.95)):
+        summary[name] = round(percentile(first_bytes, fraction) * 1000, 2) if first_bytes else None
+    summary["bytes"] = round(sum(sizes) / len(sizes)) if sizes else None
+    summary["rss_mb"] = round(peak_rss / 2 ** 20, 1) if peak_rss is not None else None
+    if errors:
+        summary["statuses"] = {str(status): count for status, count in errors.items()}
+    return summary
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    @param results: summaries of this run by configuration and scenario name
+    @param baseline: summaries of the baseline run by configuration and scenario name
+    @param tolerance: allowed relative change, e.g. 0.2 lets p95 grow and throughput drop by 20%
+    @return: descriptions of regressions, empty if there are none
+    """
+    regressions = []
+    for config, scenarios in results.items():
+        for name, result in scenarios.items():
+            if result["errors"]:
+                regressions.append(f"{config} {name}: {result['errors']} failed requests {result.get('statuses')}")
+            expected = baseline.get(config, {}).get(name)
+            if expected is None:
+                continue
+            if result["p95"] is not None and expected["p95"] and result["p95"] > expected["p95"] * (1 + tolerance):
+                regressions.append(f"{config} {name}: p95 {result['p95']} ms, baseline {expected['p95']} ms")
+            if result["throughput"] < expected["throughput"] * (1 - tolerance):
+                regressions.append(f"{config} {name}: {result['throughput']} req/s, "
+                                   f"baseline {expected['throughput']} req/s")
+    return regressions
+
+
+def print_results(results: dict, baseline: dict) -> None:
+    for config, scenarios in results.items():
+        print(f"\n{config}")
+        print(f"{'endpoint':<24}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ttfb p95':>10}"
+              f"{'bytes':>10}{'rss MB':>8}{'errors':>8}{'base p95':>10}")
+        for name, result in scenarios.items():
+            base = baseline.get(config, {}).get(name, {}).get("p95")
+            print(f"{name:<24}{result['throughput']:>10}{result['p50'] or '-':>10}{result['p95'] or '-':>10}"
+                  f"{result['p99'] or '-':>10}{result['ttfb_p95'] or '-':>10}{result['bytes'] or '-':>10}"
+                  f"{result['rss_mb'] or '-':>8}{result['errors']:>8}{base if base is not None else '-':>10}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark every route of the application")
+    parser.add_argument("--target", help="URL of running server, by default benchmark starts its own")
+    parser.add_argument("--mongo-uri", default="mongomock://", help="MONGO_URI of server started by benchmark")
+    parser.add_argument("--port", type=int, default=8765, help="port of server started by benchmark")
+    parser.add_argument("--modes", nargs="+", default=["threaded"], choices=("threaded", "prefork", "asgi"),
+                        help="modes of server started by benchmark, every one is measured")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1],
+                        help="worker processes of server in prefork and asgi modes, every number is measured")
+    parser.add_argument("--cpus", type=int, nargs="+", default=[None],
+                        help="cores server is pinned to, every number is measured, all cores by default")
+    parser.add_argument("--threads", type=int, default=16, help="request threads of server started by benchmark")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=5, help="seconds every endpoint is benchmarked for")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds of requests not counted, per endpoint")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--articles", type=int, default=1000)
+    parser.add_argument("--comments", type=int, default=5000)
+    parser.add_argument("--no-seed", action="store_true", help="use data already in the database")
+    parser.add_argument("--only", nargs="*", help="names of scenarios to run, all by default")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--update-baseline", action="store_true", help="store results of this run as the baseline")
+    return parser.parse_args()
+
+
+def configurations(args: argparse.Namespace) -> list[tuple[str, str, int, int | None]]:
+    """
+    @return: list of (name, mode, workers, cpus) of servers to measure, combinations that cannot run are left out
+    """
+    in_memory = args.mongo_uri.startswith("mongomock://")
+    configs = []
+    for mode, workers, cpus in itertools.product(args.modes, args.workers, args.cpus):
+        name = f"{mode}-w{workers}" + (f"-cpu{cpus}" if cpus else "")
+        if mode == "threaded" and workers > 1:
+            print(f"Skipping {name}, threaded server runs one process")
+        elif workers > 1 and in_memory:
+            print(f"Skipping {name}, every worker would have its own in-memory database")
+        elif mode == "asgi" and importlib.util.find_spec("uvicorn") is None:
+            print(f"Skipping {name}, uvicorn is not installed")
+        elif cpus and cpus > len(os.sched_getaffinity(0)):
+            print(f"Skipping {name}, there are only {len(os.sched_getaffinity(0))} cores")
+        else:
+            configs.append((name, mode, workers, cpus))
+    return configs
+
+
+def run_scenarios(args: argparse.Namespace, target: str, server: subprocess.Popen | None) -> dict:
+    """
+    Seeds the database of the server and runs every selected scenario against it
+    @return: summaries by scenario name
+    """
+    wait_ready(target, server)
+    if not args.no_seed:
+        seed(target, args.users, args.articles, args.comments)
+    context = prepare(target)
+
+    results = {}
+    for scenario in SCENARIOS:
+        if args.only and scenario.name not in args.only:
+            continue
+        if not scenario.mongomock and args.target is None and args.mongo_uri.startswith("mongomock://"):
+            print(f"Skipping {scenario.name}, in-memory database does not support it")
+            continue
+        if (scenario.auth or scenario.keys) and context.token is None:
+            print(f"Skipping {scenario.name}, benchmark user could not log in (are there keys in .ssh/?)")
+            continue
+        if args.warmup > 0:
+            run_scenario(target, scenario, context, args.clients, args.warmup)
+        results[scenario.name] = run_scenario(target, scenario, context, args.clients, args.duration,
+                                              server.pid if server is not None else None)
+    return results
+
+
+def main() -> int:
+    args = parse_args()
+    results = {}
+    if args.target is not None:
+        results["target"] = run_scenarios(args, args.target, None)
+    else:
+        open(SERVER_LOG_PATH, "w").close()
+        target = f"http://127.0.0.1:{args.port}"
+        for name, mode, workers, cpus in configurations(args):
+            print(f"Measuring {name}")
+            server = start_server(args.port, args.mongo_uri, mode, workers, args.threads, cpus)
+            try:
+                results[name] = run_scenarios(args, target, server)
+            finally:
+                server.terminate()
+                server.wait()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if not baseline:
+        print(f"No baseline in {args.baseline}, run with --update-baseline to store one")
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
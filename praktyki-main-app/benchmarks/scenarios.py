@@ -0,0 +1,103 @@
+"""
+Requests sent by the benchmark, one scenario for every route of the application.
+Read-only scenarios run first, so data set they read is the same on every run
+"""
+from __future__ import annotations
+import itertools
+import random
+
+
+class Context:
+    """
+    Data scenarios need to build requests - ids and authors of seeded articles and token of the benchmark user
+    """
+    def __init__(self, article_ids: list[str], authors: list[str], username: str, password: str, email: str,
+                 token: str | None):
+        self.article_ids = article_ids
+        self.authors = authors
+        self.username = username
+        self.password = password
+        self.email = email
+        self.token = token
+        self._counter = itertools.count()     # next() of itertools.count is atomic, clients can share it
+
+    def unique(self) -> int:
+        return next(self._counter)
+
+    def article_id(self) -> str:
+        return random.choice(self.article_ids)
+
+    def author(self) -> str:
+        return random.choice(self.authors)
+
+    def search_word(self) -> str:
+        return random.choice(SEARCH_WORDS)
+
+
+class Scenario:
+    """
+    One benchmarked request. Path and body can be functions of Context, called for every request
+    """
+    def __init__(self, name: str, method: str, path, body=None, headers: dict | None = None,
+                 auth: bool = False, keys: bool = False, mongomock: bool = True,
+                 expected: tuple[int, ...] = (200,)):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers or {}
+        self.auth = auth
+        self.keys = keys    # route signs tokens, it works only if server has keys in .ssh/
+        self.mongomock = mongomock  # False if route uses features in-memory stand-in does not have
+        self.expected = expected
+
+    def build(self, context: Context) -> (str, dict | None, dict):
+        """
+        @return: tuple of path with query string, body to send as JSON or None, and request headers
+        """
+        path = self.path(context) if callable(self.path) else self.path
+        body = self.body(context) if callable(self.body) else self.body
+        headers = dict(self.headers)
+        if self.auth:
+            headers["Auth"] = context.token
+        return path, body, headers
+
+
+JSON = {"Accept": "application/json"}
+# words from the Faker word list seeded articles are generated from
+SEARCH_WORDS = ["quality", "professor", "treatment", "suddenly", "environmental", "international", "responsibility"]
+
+SCENARIOS = [
+    Scenario("index", "GET", "/"),
+    Scenario("health", "GET", "/health"),
+    Scenario("metrics", "GET", "/metrics"),
+    Scenario("get_articles", "GET", "/get_articles", headers=JSON),
+    # unique query string misses the response cache, so serializer scenarios measure the database and serialization
+    Scenario("get_articles_html", "GET", lambda context: f"/get_articles?uncached={context.unique()}"),
+    Scenario("get_articles_bson", "GET", lambda context: f"/get_articles?uncached={context.unique()}",
+             headers={"Accept": "application/json; serializer=bson"}),
+    Scenario("get_articles_orjson", "GET", lambda context: f"/get_articles?uncached={context.unique()}",
+             headers={"Accept": "application/json; serializer=orjson"}),
+    Scenario("get_articles_textless", "GET", "/get_articles_textless?limit=200", headers=JSON),
+    Scenario("get_article", "GET", lambda context: f"/get_article?id={context.article_id()}", headers=JSON),
+    Scenario("search_articles", "GET", lambda context: f"/search_articles?q={context.search_word()}",
+             headers=JSON, mongomock=False),
+    Scenario("user_articles", "GET", lambda context: f"/users/{context.author()}/articles", headers=JSON),
+    Scenario("user_comments", "GET", lambda context: f"/users/{context.author()}/comments", headers=JSON),
+    Scenario("get_users", "GET", "/get_users", headers=JSON),
+    # routes hashing passwords reject requests over capacity of the hashing pool with 429, it is not a failure
+    Scenario("login", "POST", "/login", keys=True, expected=(200, 429),
+             body=lambda context: {"login_str": context.username, "password": context.password}),
+    Scenario("register", "POST", "/register", expected=(201, 429),
+             body=lambda context: {"username": f"bench{context.unique()}", "email": f"bench{context.unique()}@bench.pl",
+                                   "password": context.password}),
+    Scenario("reset_password", "POST", "/reset_password", expected=(200, 429),
+             body=lambda context: {"email": context.email, "new_password": context.password}),
+    Scenario("add_article", "POST", "/add_article", auth=True, expected=(201,),
+             body=lambda context: {"title": f"Benchmark {context.unique()}", "text": "Benchmark article " * 50}),
+    Scenario("add_comment", "POST", "/add_comment", auth=True, expected=(201, 202),
+             body=lambda context: {"article_id": context.article_id(), "text": "Benchmark comment"}),
+    Scenario("insert_random_user", "POST", "/insert_random_user", expected=(201,)),
+    Scenario("insert_random_art", "POST", "/insert_random_art", expected=(201,)),
+    Scenario("insert_random_comment", "POST", "/insert_random_comment", expected=(201,)),
+]
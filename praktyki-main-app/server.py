@@ -1,12 +1,166 @@
+import argparse
+import os
+import signal
+import threading
 import wsgiref.simple_server
-from source.app import Application
+from concurrent.futures import ThreadPoolExecutor
 
-if __name__ == "__main__":
-    server = wsgiref.simple_server.make_server(
-        host="0.0.0.0",
-        port=8000,
-        app=Application
-    )
-    print("Server started", flush=True)
-    server.serve_forever()
+from source.app import application
+from source.database import Database
+from source.logs import get_logger, shutdown_logging
+from source.exceptions import MigrationException
+from source.hashing import hasher
+from source.migrations import migrate
+from source.utils import SERVER_BACKLOG, SERVER_THREADS
+
+SERVER_MODES = ("simple", "threaded", "prefork", "asgi")
+logger = get_logger("server")
+
+
+class PooledWSGIServer(wsgiref.simple_server.WSGIServer):
+    """
+    WSGI server handling requests concurrently in a fixed pool of threads.
+    On shutdown it stops accepting connections and waits for requests in progress
+    """
+    # default of TCPServer is 5, bursts of connections would be refused before the pool could take them
+    request_queue_size = SERVER_BACKLOG
+
+    def __init__(self, server_address, handler_class, threads: int):
+        super().__init__(server_address, handler_class)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="request")
+
+    def process_request(self, request, client_address) -> None:
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+def make_server(host: str, port: int, mode: str, threads: int) -> wsgiref.simple_server.WSGIServer:
+    """
+    Creates server listening on given address, does not start serving yet
+    @param host: address to listen on
+    @param port: port to listen on
+    @param mode: one of SERVER_MODES, "simple" handles one request at a time
+    @param threads: number of request threads in every process, ignored in "simple" mode
+    @return: WSGI server with application set as the handled app
+    """
+    if mode == "simple":
+        return wsgiref.simple_server.make_server(host, port, application)
+    server = PooledWSGIServer((host, port), wsgiref.simple_server.WSGIRequestHandler, threads)
+    server.set_app(application)
+    return server
+
+
+def serve(server: wsgiref.simple_server.WSGIServer) -> None:
+    """
+    Serves requests until SIGTERM or SIGINT, then finishes requests in progress and closes the server
+    @param server: server to run
+    @return: None
+    """
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it cannot be called from the thread running it
+        threading.Thread(target=server.shutdown).start()
 
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        Database.flush_shared()
+
+
+def serve_prefork(server: wsgiref.simple_server.WSGIServer, workers: int) -> None:
+    """
+    Forks worker processes sharing listening socket of the server, each serving requests on its own.
+    Parent restarts workers that died and forwards SIGTERM/SIGINT to all of them on shutdown
+    @param server: server to run in every worker
+    @param workers: number of worker processes
+    @return: None
+    """
+    children = set()
+    stopping = False
+
+    def spawn() -> None:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(server)
+            finally:
+                # os._exit skips exit handlers, queued log records are written before it
+                shutdown_logging()
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for child in children:
+            os.kill(child, signal.SIGTERM)
+
+    for _ in range(workers):
+        spawn()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            logger.error("worker died, starting new one", extra={"fields": {"pid": pid}})
+            spawn()
+    server.socket.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the application server")
+    parser.add_argument("--host", default=os.environ.get("SERVER_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("SERVER_PORT", 8000)))
+    parser.add_argument("--mode", choices=SERVER_MODES, default=os.environ.get("SERVER_MODE", "threaded"),
+                        help="simple: one request at a time, threaded: pool of threads, "
+                             "prefork: pool of threads in each of several processes, "
+                             "asgi: event loop with source.asgi application run by uvicorn")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("SERVER_WORKERS", os.cpu_count() or 1)),
+                        help="number of processes in prefork and asgi modes")
+    parser.add_argument("--threads", type=int, default=SERVER_THREADS,
+                        help="number of request threads per process")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.mode == "asgi":
+        # uvicorn runs its own workers, migrations are applied on lifespan startup of the application
+        import uvicorn
+        uvicorn.run("source.asgi:app", host=args.host, port=args.port, workers=args.workers, lifespan="on")
+        raise SystemExit
+    if args.mode != "simple":
+        try:
+            hasher.check_request_threads(args.threads)
+        except ValueError as error:
+            logger.error("invalid number of request threads", extra={"fields": {"error": str(error)}})
+            raise SystemExit(1)
+    try:
+        migrate(Database.shared())
+    except MigrationException as error:
+        logger.error("database migration failed", extra={"fields": {"error": str(error)}})
+        raise SystemExit(1)
+    server = make_server(args.host, args.port, args.mode, args.threads)
+    logger.info("server started", extra={"fields": {"mode": args.mode, "host": args.host, "port": args.port}})
+    if args.mode == "prefork":
+        serve_prefork(server, args.workers)
+    else:
+        serve(server)
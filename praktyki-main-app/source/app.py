@@ -1,18 +1,151 @@
-import json
-from urllib import parse
+import time
+import uuid
 
-import source.exceptions as ex
 from source.auth import Auth
+from source.cache import create_response_cache
 from source.database import Database
 from source.handler import Handler
-from source.utils import HTTP_STATUS
+from source.logs import get_logger, log_request, request_id
+from source.metrics import MetricsMiddleware, registry
+from source.profiling import ProfilingMiddleware
+from source.ratelimit import create_rate_limiter
+from source.router import Router, Request
+from source.utils import HTTP_STATUS, feed_params, page_params, search_params, seed_count
 
+router = Router(cache=create_response_cache(), limiter=create_rate_limiter())
+logger = get_logger("app")
 
-def access_method(func: callable, allowed: list[str], method: str):
-    if method in allowed:
-        return func
-    else:
-        raise ex.MethodNotAllowedException(allowed)
+
+@router.route("/")
+def index(app: "Application", request: Request) -> (bytes, str):
+    return b"Index", HTTP_STATUS[200]
+
+
+@router.route("/health")
+def health(app: "Application", request: Request) -> (bytes, str):
+    if app.database.ping():
+        return b"OK", HTTP_STATUS[200]
+    return b"Database unavailable", HTTP_STATUS[503]
+
+
+@router.route("/metrics")
+def metrics(app: "Application", request: Request) -> (bytes, str):
+    request.content_type = "text/plain; version=0.0.4"
+    return registry.render().encode(), HTTP_STATUS[200]
+
+
+def seed_cost(request: Request) -> int:
+    """
+    Seeding routes take one token of "seed" budget per inserted document, invalid count is rejected by the route
+    """
+    try:
+        return seed_count(request.get_input)
+    except ValueError:
+        return 1
+
+
+def posted_accounts(request: Request) -> list[str]:
+    """
+    Usernames and emails posted to login routes, every one has its own bucket of "login" budget
+    """
+    try:
+        post_input = request.post_input
+    except ValueError:
+        return []
+    if not isinstance(post_input, dict):
+        return []
+    return [post_input[field][:256] for field in ("login_str", "username", "email")
+            if isinstance(post_input.get(field), str)]
+
+
+@router.route("/insert_random_user", methods=("GET", "POST"), limit="seed", cost=seed_cost)
+def insert_random_user(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.insert_random_user(seed_count(request.get_input))
+
+
+@router.route("/insert_random_art", methods=("GET", "POST"), invalidates=("articles",), limit="seed",
+              cost=seed_cost)
+def insert_random_article(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.insert_random_article(seed_count(request.get_input))
+
+
+@router.route("/insert_random_comment", methods=("GET", "POST"), invalidates=("articles",), limit="seed",
+              cost=seed_cost)
+def insert_random_comment(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.insert_random_comment(seed_count(request.get_input))
+
+
+@router.route("/get_articles", json=True, cache="articles")
+def get_articles(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.get_articles(*page_params(request.get_input), compact=request.compact,
+                                   serializer=request.serializer)
+
+
+@router.route("/get_articles_textless", json=True, cache="articles")
+def get_articles_textless(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.get_articles_textless(*page_params(request.get_input), compact=request.compact,
+                                            serializer=request.serializer)
+
+
+@router.route("/get_article", json=True, cache="articles")
+def get_article(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.get_article(request.get_input, compact=request.compact,
+                                  serializer=request.serializer)
+
+
+@router.route("/search_articles", json=True, cache="articles")
+def search_articles(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.search_articles(*search_params(request.get_input), compact=request.compact,
+                                      serializer=request.serializer)
+
+
+@router.route("/get_users", json=True)
+def get_users(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.get_users(*page_params(request.get_input), compact=request.compact,
+                                serializer=request.serializer)
+
+
+@router.route("/users/<name>/articles", json=True)
+def get_user_articles(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.get_user_articles(request.path_params["name"], *feed_params(request.get_input),
+                                        compact=request.compact, serializer=request.serializer)
+
+
+@router.route("/users/<name>/comments", json=True)
+def get_user_comments(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.get_user_comments(request.path_params["name"], *feed_params(request.get_input),
+                                        compact=request.compact, serializer=request.serializer)
+
+
+@router.route("/add_article", methods=("POST",), auth=True, invalidates=("articles",), limit="write")
+def add_article(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.add_article(request.username, request.post_input)
+
+
+def comments_written(batch: list[dict]) -> None:
+    # buffered comments change articles once they are written, not when the request returns 202 Accepted
+    if router.cache is not None:
+        router.cache.invalidate("articles")
+
+
+@router.route("/add_comment", methods=("POST",), auth=True, invalidates=("articles",), limit="write")
+def add_comment(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.add_comment(request.username, request.post_input, written=comments_written)
+
+
+@router.route("/register", methods=("POST",), limit="login", limit_keys=posted_accounts)
+def register(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.register(request.post_input)
+
+
+@router.route("/login", methods=("POST",), limit="login", limit_keys=posted_accounts)
+def login(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.login(request.post_input)
+
+
+@router.route("/reset_password", methods=("POST",), limit="login", limit_keys=posted_accounts)
+def reset_password(app: "Application", request: Request) -> (bytes, str):
+    return app.handle.reset_password(request.post_input)
 
 
 class Application:
@@ -21,7 +154,7 @@ class Application:
     """
     def __init__(self, environ, start_response):
         """
-        Initiates environment and database connection
+        Initiates environment and takes database connection shared by all requests in this process
         :param environ:
         :param start_response:
         """
@@ -29,7 +162,7 @@ class Application:
         self.start_response = start_response
         self.auth = Auth()
 
-        self.database = Database()
+        self.database = Database.shared()
         self.handle = Handler(self.database)
 
     def __iter__(self):
@@ -37,93 +170,39 @@ class Application:
         Iterator handles request given from the server.py
         :return: response to the server
         """
-        print("Received http request")
-        path = self.environ['PATH_INFO']
-
-        method = self.environ['REQUEST_METHOD']
-        get_input = parse.parse_qs(self.environ['QUERY_STRING'])
-        post_input = {}
-        if method == "POST":
-            input_obj = self.environ['wsgi.input']
-            input_len = int(self.environ['CONTENT_LENGTH'])
-            post_input = json.loads(input_obj.read(input_len).decode())
-
-        status = "501 Not Implemented"
-        response = b"501 Not Implemented"
+        start = time.perf_counter()
+        # id given by proxy in front of the application is kept, so its logs can be matched with ours
+        rid = self.environ.get("HTTP_X_REQUEST_ID") or uuid.uuid4().hex
+        request_id.set(rid)
+        request = Request(self.environ)
+        request.response_headers.append(("X-Request-Id", rid))
         try:
-            auth_token = None
-            username = None
-            if 'HTTP_AUTH' in self.environ:
-                auth_token = self.environ['HTTP_AUTH']
-                username = self.auth.authenticate(auth_token)
-
-            match path:
-                case "/test":
-                    pass
-                case "/":
-                    response = b"Index"
-                    status = HTTP_STATUS[200]
-                case "/insert_random_user":
-                    response, status = self.handle.insert_random_user()
-                case "/insert_random_art":
-                    response, satus = self.handle.insert_random_article()
-                case "/insert_random_comment":
-                    response, status = self.handle.insert_random_comment()
-                case "/get_articles":
-                    response, status = self.handle.get_articles()
-                case "/get_articles_textless":
-                    response, status = self.handle.get_articles_textless()
-                case "/get_article":
-                    if get_input is not None:
-                        response, status = self.handle.get_article(get_input)
-                    else:
-                        response, status = b'', HTTP_STATUS[204]
-                case "/get_users":
-                    response, status = self.handle.get_users()
-                case "/add_article":
-                    if method == "POST":
-                        if auth_token:
-                            response, status = self.handle.add_article(username, post_input)
-                        else:
-                            raise ex.NotLoggedInException
-                    else:
-                        raise ex.MethodNotAllowedException("POST")
-                case "/add_comment":
-                    if method == "POST":
-                        if auth_token:
-                            response, status = self.handle.add_comment(username, post_input)
-                        else:
-                            raise ex.NotLoggedInException
-                    else:
-                        raise ex.MethodNotAllowedException("POST")
-
-                case "/register":
-                    if method == "POST":
-                        response, status = self.handle.register(post_input)
-                    else:
-                        raise ex.MethodNotAllowedException("POST")
-                case "/login":
-                    if method == "POST":
-                        response, status = self.handle.login(post_input)
-                    else:
-                        raise ex.MethodNotAllowedException("POST")
-                case "/reset_password":
-                    if method == "POST":
-                        response, status = self.handle.reset_password(post_input)
-                    else:
-                        raise ex.MethodNotAllowedException("POST")
-                case "/protected":
-                    response, status = b"dupa", "zupa"
-                case _:
-                    response = b"404 Not Found"
-                    status = HTTP_STATUS[404]
+            response, status = router.dispatch(self, request)
+            content_type = request.content_type
         except Exception as error:
             response, status = self.handle.error_handler(error)
+            content_type = "text/html; charset=utf-8"
+
+        if isinstance(response, bytes):
+            headers = [
+                ("Content-Type", content_type),
+                ("content-Length", str(len(response)))
+            ]
+            self.start_response(status, headers + request.response_headers)
+            log_request(logger, request.method, request.path, status, time.perf_counter() - start)
+            yield response
+            return
+
+        # streamed response, length is unknown so server sends it chunked or closes connection after it
+        self.start_response(status, [("Content-Type", content_type)] + request.response_headers)
+        try:
+            yield from response
+        except Exception:
+            # status is already sent, the only thing left is to cut the response short
+            logger.exception("streamed response failed", extra={"fields": {"route": request.path}})
+            return
+        log_request(logger, request.method, request.path, status, time.perf_counter() - start)
 
-        headers = [
-            ("Content-Type", "text/html"),
-            ("content-Length", str(len(response)))
-        ]
 
-        self.start_response(status, headers)
-        yield response
+# Application wrapped with collection of request metrics and profiling, this is what servers run
+application = MetricsMiddleware(ProfilingMiddleware(Application, router.route_name), router.route_name)
@@ -0,0 +1,113 @@
+from __future__ import annotations
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from source.app import application
+from source.database import Database
+from source.exceptions import MigrationException
+from source.migrations import migrate
+from source.utils import ASGI_THREADS
+
+
+class AsyncApplication:
+    """
+    ASGI version of the application. Connections are handled by the event loop, so thousands of slow clients
+    can wait at once, while routing and handlers are the same ones Application uses. Blocking database work
+    runs in a bounded pool of threads, the same way async MongoDB drivers wrap pymongo
+    """
+    def __init__(self, threads: int = ASGI_THREADS):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="asgi")
+
+    async def __call__(self, scope: dict, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send) -> None:
+        """
+        Applies migrations on startup and waits for requests in progress on shutdown
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await loop.run_in_executor(self.executor, migrate, Database.shared())
+                except MigrationException as error:
+                    await send({"type": "lifespan.startup.failed", "message": str(error)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await loop.run_in_executor(None, self.executor.shutdown)
+                await loop.run_in_executor(None, Database.flush_shared)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope: dict, receive, send) -> None:
+        """
+        Reads whole request body, runs Application in the thread pool and sends its response chunk by chunk
+        """
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body", False):
+                break
+
+        started = {}
+
+        def start_response(status: str, headers: list[tuple[str, str]], exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                  for name, value in headers]
+
+        loop = asyncio.get_running_loop()
+        environ = self.environ(scope, body)
+        chunks = iter(await loop.run_in_executor(self.executor, application, environ, start_response))
+        chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+        await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+        if chunk is None:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        while chunk is not None:
+            following = await loop.run_in_executor(self.executor, next, chunks, None)
+            await send({"type": "http.response.body", "body": chunk, "more_body": following is not None})
+            chunk = following
+
+    @staticmethod
+    def environ(scope: dict, body: bytes) -> dict:
+        """
+        Translates ASGI connection scope into WSGI environment understood by Application
+        """
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", ""),
+            "PATH_INFO": scope["path"],
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "SERVER_NAME": (scope.get("server") or ("localhost", 0))[0],
+            "SERVER_PORT": str((scope.get("server") or ("localhost", 0))[1]),
+            "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            # response iterator is advanced by different threads of the pool, see ProfilingMiddleware
+            "praktyki.resumed_in_threads": True,
+        }
+        for name, value in scope.get("headers", []):
+            key = name.decode("latin-1").upper().replace("-", "_")
+            if key == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value.decode("latin-1")
+            elif key != "CONTENT_LENGTH":
+                environ[f"HTTP_{key}"] = value.decode("latin-1")
+        return environ
+
+
+app = AsyncApplication()
@@ -1,46 +1,106 @@
-
 import datetime
+import os
+import threading
+import time
 
 import pymongo.collection
 import jwt
 from cryptography.hazmat.primitives import serialization
 
+from source.cache import TTLCache
 from source.database import Database
+from source.metrics import JWT_LATENCY
+from source.utils import KEY_CHECK_INTERVAL, TOKEN_CACHE_SIZE, TOKEN_LIFETIME
+
+
+class KeyStore:
+    """
+    Keeps parsed RSA keys in memory, so they are read and parsed once per process.
+    Key files are checked for changes at most once every KEY_CHECK_INTERVAL seconds
+    and reloaded when they are modified
+    """
+    def __init__(self, public_path: str, private_path: str):
+        self.public_path = public_path
+        self.private_path = private_path
+        self.generation = 0     # incremented on every reload, lets dependent caches notice key rotation
+        self._public_key = None
+        self._private_key = None
+        self._mtimes = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _file_mtimes(self) -> tuple[float, float]:
+        return os.stat(self.public_path).st_mtime, os.stat(self.private_path).st_mtime
+
+    def _refresh(self) -> None:
+        """
+        Loads keys on first use and reloads them if files changed since last check
+        @return: None
+        """
+        now = time.monotonic()
+        if self._mtimes is not None and now - self._checked_at < KEY_CHECK_INTERVAL:
+            return
+        with self._lock:
+            if self._mtimes is not None and now - self._checked_at < KEY_CHECK_INTERVAL:
+                return
+            mtimes = self._file_mtimes()
+            if mtimes != self._mtimes:
+                with open(self.public_path, "r") as file:
+                    self._public_key = serialization.load_ssh_public_key(file.read().encode())
+                with open(self.private_path, "r") as file:
+                    self._private_key = serialization.load_ssh_private_key(file.read().encode(), password=b'')
+                self._mtimes = mtimes
+                self.generation += 1
+            self._checked_at = now
+
+    @property
+    def public_key(self):
+        self._refresh()
+        return self._public_key
+
+    @property
+    def private_key(self):
+        self._refresh()
+        return self._private_key
 
 
 class Auth:
-    def __init__(self):
-        self.public_key = open(".ssh/id_rsa.pub", "r").read()
-        self.private_key = open('.ssh/id_rsa', 'r').read()
+    keys = KeyStore(".ssh/id_rsa.pub", ".ssh/id_rsa")
+    # verified tokens mapped to (key generation, username), entries expire together with the token
+    verified_tokens = TTLCache(TOKEN_CACHE_SIZE, TOKEN_LIFETIME.total_seconds())
 
     def authenticate(self, token) -> str:
         """
         Decode given token using public key and return associated username.
+        Tokens that were already verified are served from cache until they expire.
         Error handling is taken care of in the main Application class
         :param token: token taken from the header of a request
         :return: associated username as a string
         """
-        key = serialization.load_ssh_public_key(self.public_key.encode())
-        payload = jwt.decode(token, key=key, algorithms=['RS256', ])
+        key = Auth.keys.public_key
+        cached = Auth.verified_tokens.get(token)
+        if cached is not None and cached[0] == Auth.keys.generation:
+            return cached[1]
+
+        with JWT_LATENCY.time():
+            payload = jwt.decode(token, key=key, algorithms=['RS256', ])
+        Auth.verified_tokens.set(token, (Auth.keys.generation, payload["username"]), expires_at=payload["exp"])
         return payload["username"]
 
     def generate_login_token(self, username: str) -> str:
         """
-
-        @param username:
-        @return:
+        Generate token authenticating user for TOKEN_LIFETIME
+        @param username: username of logged in user
+        @return: encoded jwt token
         """
-        key = serialization.load_ssh_private_key(self.private_key.encode(), password=b'')
-
         # in token could have used _id, but usernames are unique and human readable so I decided to use them instead
         token = jwt.encode(
             payload={
                 "username": username,
-                "exp": datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(hours=8)
+                "exp": datetime.datetime.now(tz=datetime.timezone.utc) + TOKEN_LIFETIME
             },
-            key=key,
+            key=Auth.keys.private_key,
             algorithm='RS256'
         )
 
         return token
-
@@ -0,0 +1,183 @@
+from __future__ import annotations
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from source.utils import CACHE_BACKEND, CACHE_REDIS_URL, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL
+
+
+class TTLCache:
+    """
+    Thread-safe in-memory cache with bounded size. Least recently used entries are evicted
+    when the cache is full, and every entry expires after its own time to live
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        """
+        @param maxsize: maximum number of entries kept in the cache
+        @param ttl: default time to live of an entry in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key: (expires_at, value), ordered from least recently used
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Returns value stored under key, or default if there is none or it has expired
+        @param key: hashable key of the entry
+        @param default: value returned on cache miss
+        @return: cached value or default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float | None = None, expires_at: float | None = None) -> None:
+        """
+        Stores value under key, evicting least recently used entry if cache is full
+        @param key: hashable key of the entry
+        @param value: value to store
+        @param ttl: time to live in seconds, defaults to the one given on creation
+        @param expires_at: unix timestamp of expiry, overrides ttl if it comes sooner
+        @return: None
+        """
+        expiry = time.time() + (self.ttl if ttl is None else ttl)
+        if expires_at is not None:
+            expiry = min(expiry, expires_at)
+        with self._lock:
+            self._entries[key] = (expiry, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key) -> None:
+        """
+        Removes entry from the cache, does nothing if there is no such entry
+        @param key: hashable key of the entry
+        @return: None
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class LocalCacheBackend:
+    """
+    Cache backend keeping entries in memory of the current process. Used by default, and as a stand-in
+    for the shared backend when every worker can keep its own copy
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.entries = TTLCache(maxsize, ttl)
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        return self.entries.get(key)
+
+    def set(self, key: str, value, ttl: float) -> None:
+        self.entries.set(key, value, ttl)
+
+    def counter(self, key: str) -> int:
+        return self._counters.get(key, 0)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+class RedisCacheBackend:
+    """
+    Cache backend shared by all workers and servers, kept in Redis. Requires redis package
+    """
+    def __init__(self, url: str, prefix: str = "praktyki:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key: str):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key: str, value, ttl: float) -> None:
+        self.client.set(self.prefix + key, pickle.dumps(value), px=int(ttl * 1000))
+
+    def counter(self, key: str) -> int:
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def incr(self, key: str) -> int:
+        return self.client.incr(self.prefix + key)
+
+
+class ResponseCache:
+    """
+    Read-through cache of response bodies, split into namespaces (e.g. "articles").
+    Every namespace has a generation number which is a part of entry keys - invalidating
+    the namespace increments it, so all entries cached before become unreachable and expire on their own
+    """
+    def __init__(self, backend: LocalCacheBackend | RedisCacheBackend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+
+    def entry_key(self, namespace: str, key: str) -> str:
+        """
+        Key of the entry in the current generation of the namespace. It is read once per request and used
+        for both get and set, so a body computed while the namespace was invalidated is stored
+        under the old generation, where it is never read
+        @param namespace: namespace of the entry
+        @param key: key of the entry within namespace, e.g. path with query string
+        @return: key of the entry in the backend
+        """
+        return f"{namespace}:{self.backend.counter(f'generation:{namespace}')}:{key}"
+
+    def get(self, entry_key: str) -> tuple[bytes, str] | None:
+        """
+        @param entry_key: key returned by entry_key()
+        @return: tuple of cached body and its ETag, or None if entry is not cached
+        """
+        return self.backend.get(entry_key)
+
+    def set(self, entry_key: str, body: bytes) -> str:
+        """
+        Caches response body
+        @param entry_key: key returned by entry_key() before the body was computed
+        @param body: response body
+        @return: ETag of the body
+        """
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        self.backend.set(entry_key, (body, etag), self.ttl)
+        return etag
+
+    def invalidate(self, namespace: str) -> None:
+        """
+        Drops all entries in namespace
+        @param namespace: namespace to invalidate
+        @return: None
+        """
+        self.backend.incr(f"generation:{namespace}")
+
+
+def create_response_cache() -> ResponseCache:
+    """
+    Creates response cache with backend selected by CACHE_BACKEND setting
+    """
+    if CACHE_BACKEND == "redis":
+        backend = RedisCacheBackend(CACHE_REDIS_URL)
+    else:
+        backend = LocalCacheBackend(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+    return ResponseCache(backend, RESPONSE_CACHE_TTL)
@@ -0,0 +1,70 @@
+from __future__ import annotations
+from collections import Counter
+
+from source.collections.articles import Article
+from source.database import Database
+from source.utils import SUMMARY_BATCH_SIZE
+
+
+class ArticleSummary:
+    """
+    Materialised summaries of articles kept in 'article_summaries' collection - article without its text,
+    plus number of its comments. Listings read them as they are, instead of counting comments on every request.
+    Summaries share _id with their articles, they are added when articles are written
+    and their comment counts are incremented when comments are written
+    """
+    collection = "article_summaries"
+
+    @staticmethod
+    def of(article: dict, comment_count: int = 0) -> dict:
+        """
+        :param article: article with its _id, text is left out of the summary
+        :param comment_count: number of comments of the article
+        :return: summary of the article
+        """
+        summary = {key: value for key, value in article.items() if key != "text"}
+        summary["comment_count"] = comment_count
+        return summary
+
+    @staticmethod
+    def add(database: Database, articles: list[dict]) -> None:
+        """
+        Writes summaries of newly inserted articles
+        :param database: database connection object
+        :param articles: inserted articles, with _id set by the insert
+        :return: None
+        """
+        database.insert_many(ArticleSummary.collection, [ArticleSummary.of(article) for article in articles])
+
+    @staticmethod
+    def count_comments(database: Database, comments: list[dict]) -> None:
+        """
+        Increments comment counts of articles the newly inserted comments belong to
+        :param database: database connection object
+        :param comments: inserted comments
+        :return: None
+        """
+        database.increment_many(ArticleSummary.collection, "comment_count",
+                                dict(Counter(comment["article_id"] for comment in comments)))
+
+    @staticmethod
+    def rebuild(database: Database, batch_size: int = SUMMARY_BATCH_SIZE) -> int:
+        """
+        Recomputes summaries of all articles, batch by batch, e.g. to backfill them or fix counts that drifted.
+        Comments written to a batch while it is recomputed may be left out of its counts,
+        so it should be run when comments are not being written
+        :param database: database connection object
+        :param batch_size: number of articles recomputed at once
+        :return: number of rebuilt summaries
+        """
+        rebuilt = 0
+        after = None
+        while True:
+            articles = list(database.iter_page("articles", batch_size, after, projection=Article.summary_fields))
+            if not articles:
+                return rebuilt
+            counts = database.count_grouped("comments", "article_id", [article["_id"] for article in articles])
+            database.replace_many(ArticleSummary.collection,
+                                  [ArticleSummary.of(article, counts[article["_id"]]) for article in articles])
+            rebuilt += len(articles)
+            after = articles[-1]["_id"]
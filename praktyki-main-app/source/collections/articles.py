@@ -1,4 +1,5 @@
 from __future__ import annotations
+import re
 from datetime import datetime
 
 import pymongo.database
@@ -40,6 +41,12 @@ class Article:
       }
     }
 
+    # Projections - fields fetched from 'articles' collection for specific purposes
+    summary_fields = {"text": 0}    # everything but the article body
+    id_field = {"_id": 1}   # only for checking existence
+    # what is needed for search results, text is cut by database, see search_projection
+    search_fields = {"title": 1, "date_created": 1, "author": 1}
+
     def __init__(self, title: str, text: str, date_created: datetime, author_id, author_username, author_email):
         self.json = {
             "title": title,
@@ -68,6 +75,63 @@ class Article:
     def author(self) -> dict:
         return self.json["author"]
 
+    @staticmethod
+    def search_pattern(query: str) -> str | None:
+        """
+        :param query: full-text search query, negated words and phrase quotes are ignored
+        :return: regular expression matching beginning of any word of the query, None if there are no such words
+        """
+        words = [word.strip('"') for word in query.split() if not word.startswith("-")]
+        words = [re.escape(word) for word in words if word]
+        return r"\b(" + "|".join(words) + ")" if words else None
+
+    @staticmethod
+    def search_projection(query: str, length: int) -> dict:
+        """
+        Projection of search results with a window of the text around the first word of the query found in it,
+        so database sends at most twice the snippet length instead of whole article. Window is cut to the snippet
+        with snippet(), its position and length of the whole text are kept for the ellipsis
+        :param query: full-text search query
+        :param length: length of the snippet
+        :return: projection for Database.search_text, with "window", "window_start" and "text_length" fields
+        """
+        pattern = Article.search_pattern(query)
+        # plain 0 in inclusion projection would mean excluding the field
+        start = {"$literal": 0}
+        if pattern is not None:
+            found = {"$regexFind": {"input": "$text", "regex": pattern, "options": "i"}}
+            position = {"$let": {"vars": {"found": found}, "in": {"$ifNull": ["$$found.idx", 0]}}}
+            start = {"$max": [0, {"$subtract": [position, length // 2]}]}
+        return {**Article.search_fields,
+                "window_start": start,
+                "window": {"$substrCP": ["$text", start, 2 * length]},
+                "text_length": {"$strLenCP": "$text"}}
+
+    @staticmethod
+    def snippet(text: str, query: str, length: int, offset: int = 0, total: int | None = None) -> str:
+        """
+        Cuts fragment of the text around the first word of the query found in it
+        :param text: text of an article, or a window of it
+        :param query: full-text search query, negated words and phrase quotes are ignored
+        :param length: maximum length of the fragment, without added ellipsis
+        :param offset: position of the window in the whole text, 0 when whole text is given
+        :param total: length of the whole text, None when whole text is given
+        :return: fragment of the text, beginning of the text if no word of the query is found
+        """
+        pattern = Article.search_pattern(query)
+        match = re.search(pattern, text, re.IGNORECASE) if pattern else None
+        start = max(0, match.start() - length // 4) if match else 0
+        if start > 0:
+            # do not start in the middle of a word
+            space = text.find(" ", start, match.start())
+            start = space + 1 if space != -1 else start
+        end = min(len(text), start + length)
+        if end < len(text):
+            space = text.rfind(" ", start, end)
+            end = space if space > start else end
+        total = len(text) if total is None else total
+        return ("..." if offset + start > 0 else "") + text[start:end] + ("..." if offset + end < total else "")
+
     @staticmethod
     def create_articles_collection(database: pymongo.database.Database) -> None:
         """
@@ -79,16 +143,18 @@ class Article:
             database.create_collection("articles", validator=Article.validation)
 
     @staticmethod
-    def create_random_article(database: Database) -> Article:
+    def create_random_article(database: Database, fake: Faker | None = None, author: dict | None = None) -> Article:
         """
         Adds random article generated with Faker for testing purposes.
         User gets randomly sellected from existing collection of users
         :param database: connected mongodb database
+        :param fake: Faker instance to reuse, new one is created if not given
+        :param author: user to write the article as, random user if not given
         :return: None
         """
 
-        author = database.random_one("users")
-        fake = Faker()
+        author = author or database.random_one("users")
+        fake = fake or Faker()
         return Article(fake.sentence(), fake.paragraph(nb_sentences=10), fake.date_time(),
                        author.get("_id"), author.get("username"), author.get("email"))
 
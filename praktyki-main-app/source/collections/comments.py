@@ -41,6 +41,9 @@ class Comment:
       }
     }
 
+    # Projections - fields fetched from 'comments' collection for specific purposes
+    feed_fields = {"author": 0}     # comments listed on page of their author, who is known already
+
     def __init__(self, article_id: ObjectId, text: str, date_created: datetime,
                  author_id: ObjectId, author_username: str, author_email: str):
         self.json = {
@@ -81,18 +84,22 @@ class Comment:
             database.create_collection("comments", validator=Comment.validation)
 
     @staticmethod
-    def create_random_comment(database: Database) -> Comment:
+    def create_random_comment(database: Database, fake: Faker | None = None, author: dict | None = None,
+                              article_id: ObjectId | None = None) -> Comment:
         """
         Adds random comment generated with Faker for testing purposes.
         User and article get randomly sellected from existing collections
         :param database: connected mongodb database
+        :param fake: Faker instance to reuse, new one is created if not given
+        :param author: user to write the comment as, random user if not given
+        :param article_id: article to comment, random article if not given
         :return: None
         """
 
-        author = database.random_one("users")
-        article = database.random_one("articles")
-        fake = Faker()
-        return Comment(article.get("_id"), fake.paragraph(nb_sentences=2), fake.date_time(),
+        author = author or database.random_one("users")
+        article_id = article_id or database.random_one("articles").get("_id")
+        fake = fake or Faker()
+        return Comment(article_id, fake.paragraph(nb_sentences=2), fake.date_time(),
                        author.get("_id"), author.get("username"), author.get("email"))
 
         # database.insert("articles", {
@@ -1,15 +1,18 @@
 from __future__ import annotations
 import re
-import hashlib
+import hmac
 import datetime
 import os
 
 import pymongo.database
+import pymongo.errors
 from faker import Faker
 
 from source.auth import Auth
+from source.cache import TTLCache
 from source.database import Database
-from source.utils import REGEX_EMAIL, HASH_ITERS
+from source.hashing import hasher
+from source.utils import REGEX_EMAIL, HASH_VERSION, AUTHOR_CACHE_SIZE, AUTHOR_CACHE_TTL
 
 
 class User:
@@ -32,6 +35,9 @@ class User:
           "salt": {
             "bsonType": "binData"
           },
+          "hash_version": {
+            "bsonType": "int"
+          },
           "active": {
             "bsonType": "bool"
           },
@@ -48,6 +54,16 @@ class User:
       }
     }
 
+    # Projections - fields fetched from 'users' collection for specific purposes
+    public_fields = {"password": 0, "salt": 0}      # everything that can be shown to other users
+    author_fields = {"username": 1, "email": 1}     # what is embedded as author of articles and comments
+    login_fields = {"username": 1, "password": 1, "salt": 1, "hash_version": 1}    # what is needed to verify password
+    id_field = {"_id": 1}   # only for checking existence
+    username_field = {"username": 1}    # who the account belongs to, e.g. on password reset
+
+    # username: author stub embedded in articles and comments written by the user, saves a lookup on every write
+    author_cache = TTLCache(AUTHOR_CACHE_SIZE, AUTHOR_CACHE_TTL)
+
     def __init__(self, username: str, email: str, password, salt,
                  active, date_created):
         self.json = {
@@ -70,17 +86,36 @@ class User:
             database.create_collection("users", validator=User.validation)
 
     @staticmethod
-    def add_random_user() -> User:
+    def add_random_user(fake: Faker | None = None) -> User:
         """
         Adds random user  generated with Faker for testing purposes.
         Login for generated user is impossible because of randomly generated and unrelated salt and hashed password
+        :param fake: Faker instance to reuse, new one is created if not given
         :return: None
         """
 
-        fake = Faker()
+        fake = fake or Faker()
         return User(fake.user_name(), fake.email(), fake.binary(512),
                     fake.binary(32), fake.boolean(), fake.date_time())
 
+    @staticmethod
+    def author(username: str, database: Database) -> dict:
+        """
+        Returns author stub of user - the part of user embedded in articles and comments.
+        Stubs are cached, database is queried only on cache miss
+        :param username: username of existing user
+        :param database: database connection object
+        :return: dict with id, username and email of the user
+        """
+        stub = User.author_cache.get(username)
+        if stub is None:
+            user = database.search_one("users", {"username": username}, User.author_fields)
+            if not user:
+                raise ValueError(f"There is no user identified by {username}")
+            stub = {"id": user.get("_id"), "username": user.get("username"), "email": user.get("email")}
+            User.author_cache.set(username, stub)
+        return stub
+
     @staticmethod
     def login(login_str: str, password: str, database: Database) -> str:
         """
@@ -91,23 +126,27 @@ class User:
         :return: encoded jwt token authenticating user for 8 hours
         """
         if re.fullmatch(REGEX_EMAIL, login_str):
-            user = database.search_one("users", {"email": login_str})
+            user = database.search_one("users", {"email": login_str}, User.login_fields)
         else:
-            user = database.search_one("users", {"username": login_str})
+            user = database.search_one("users", {"username": login_str}, User.login_fields)
 
         if not user:
             raise ValueError(f"There is no user identified by {login_str}")
 
         salt = user.get("salt")
-        # start = time.time_ns()
-        hashed_pswd = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), salt, HASH_ITERS)
-        # end = time.time_ns()
-        # print(f"Hashing time: {end-start} ns")
-        if user.get("password") != hashed_pswd:
+        version = user.get("hash_version", 1)   # users registered before versioning use version 1
+        hashed_pswd = hasher.hash(password, salt, version)
+        if not hmac.compare_digest(user.get("password"), hashed_pswd):
             raise ValueError(f"Invalid password")
 
-        database.find_one_and_update("users", {"_id": user.get("_id")},
-                                     {"$set": {"last_login": datetime.datetime.now()}})
+        update = {"last_login": datetime.datetime.now()}
+        if version != HASH_VERSION:
+            # password is known only now, so it is the moment to move it to current hashing parameters
+            update["salt"] = os.urandom(32)
+            update["password"] = hasher.hash(password, update["salt"])
+            update["hash_version"] = HASH_VERSION
+        database.find_one_and_update("users", {"_id": user.get("_id")}, {"$set": update})
+        User.author_cache.delete(user.get("username"))
 
         auth = Auth()
         return auth.generate_login_token(user.get("username"))
@@ -134,22 +173,27 @@ class User:
         if len(email) > 256:
             raise ValueError("Email address cannot exceed 256 characters")
 
-        if database.search_one("users", {"username": username}):
+        if database.search_one("users", {"username": username}, User.id_field):
             raise ValueError("Username already taken")
-        if database.search_one("users", {"email": email}):
+        if database.search_one("users", {"email": email}, User.id_field):
             raise ValueError("Email already in use")
 
         salt = os.urandom(32)
-        hashed_pswd = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), salt, HASH_ITERS)
-
-        database.insert("users", {
-            "username": username,
-            "email": email,
-            "password": hashed_pswd,
-            "salt": salt,
-            "active": True,
-            "date_created": datetime.datetime.now()
-        })
+        hashed_pswd = hasher.hash(password, salt)
+
+        try:
+            database.insert("users", {
+                "username": username,
+                "email": email,
+                "password": hashed_pswd,
+                "salt": salt,
+                "hash_version": HASH_VERSION,
+                "active": True,
+                "date_created": datetime.datetime.now()
+            })
+        except pymongo.errors.DuplicateKeyError:
+            # someone registered the same username or email in the meantime, caught by unique index
+            raise ValueError("Username or email already taken")
 
     @staticmethod
     def reset_password(email: str, new_password: str, database: Database) -> None:
@@ -164,7 +208,8 @@ class User:
         :return: None
         """
         user = database.search_one("users",
-                                   {"email": email})  # in real life it should be controlled by tokenized emails
+                                   {"email": email},
+                                   User.username_field)  # in real life it should be controlled by tokenized emails
 
         if not user:
             raise ValueError(f"There is no user identified by {email}")
@@ -173,7 +218,8 @@ class User:
             raise ValueError("Password needs to be between 8 and 64 characters long")
 
         salt = os.urandom(32)
-        hashed_pswd = hashlib.pbkdf2_hmac('sha512', new_password.encode('utf-8'), salt, HASH_ITERS)
+        hashed_pswd = hasher.hash(new_password, salt)
 
         database.find_one_and_update("users", {"_id": user.get("_id")},
-                                     {"$set": {"password": hashed_pswd, "salt": salt}})
+                                     {"$set": {"password": hashed_pswd, "salt": salt, "hash_version": HASH_VERSION}})
+        User.author_cache.delete(user.get("username"))
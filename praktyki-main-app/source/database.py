@@ -1,71 +1,367 @@
+from __future__ import annotations
+import atexit
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Iterator
+
 import pymongo.collection
+import pymongo.errors
+from bson import ObjectId
 from pymongo import MongoClient
 from pymongo.server_api import ServerApi
 
+from source.logs import get_logger
+from source.metrics import DB_LATENCY, Counter, registry, timed, timed_iter
+from source.profiling import command_logger
+from source.utils import (DATABASE_NAME, MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_TIME_MS,
+                          MONGO_HEARTBEAT_MS, MONGO_TIMEOUT_MS, MONGO_URI, WRITE_BUFFER_SIZE, WRITE_BUFFER_INTERVAL)
+
+logger = get_logger("database")
+BUFFERED_WRITES_FAILED = registry.register(Counter(
+    "buffered_writes_failed_total", "Objects of write buffers the database rejected or failed to write",
+    ("collection",)))
+
+
+class WriteBuffer:
+    """
+    Write-behind buffer for inserts into one collection. Inserted objects are collected and written
+    with one insert_many when batch_size objects are waiting or interval seconds passed since the first of them.
+    Every insert returns a future, resolved once the object is written - callers needing acknowledgement wait for it.
+    Optional on_written function is called in the writer thread with list of objects written by every batch
+    """
+    def __init__(self, collection: pymongo.collection.Collection, batch_size: int, interval: float,
+                 on_written: callable = None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.interval = interval
+        self.on_written = on_written
+        self._pending = []      # list of (object, future) waiting to be written
+        self._condition = threading.Condition()
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name=f"write-buffer-{collection.name}", daemon=True)
+        self._writer.start()
+
+    def insert(self, object_dict: dict) -> Future:
+        """
+        Queues object to be inserted
+        @param object_dict: object to insert, represented as key: value pairs
+        @return: future resolved with None when object is written, or with exception if writing failed
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Write buffer is closed")
+            self._pending.append((object_dict, future))
+            if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+                self._condition.notify()
+        return future
+
+    def _take_batch(self) -> list[tuple[dict, Future]]:
+        batch = self._pending[:self.batch_size]
+        del self._pending[:self.batch_size]
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                deadline = time.monotonic() + self.interval
+                while len(self._pending) < self.batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._take_batch()
+            self._write(batch)
+
+    def _write(self, batch: list[tuple[dict, Future]]) -> None:
+        failed = {}     # index in batch: error of objects rejected by database
+        try:
+            with DB_LATENCY.time(operation="buffered_insert_many"):
+                self.collection.insert_many([object_dict for object_dict, _ in batch], ordered=False)
+        except pymongo.errors.BulkWriteError as error:
+            for write_error in error.details.get("writeErrors", []):
+                failed[write_error["index"]] = pymongo.errors.WriteError(write_error.get("errmsg"),
+                                                                         write_error.get("code"), write_error)
+            # writes of clients that did not wait for acknowledgement fail silently otherwise
+            logger.error("buffered objects rejected", extra={"fields": {
+                "collection": self.collection.name, "objects": len(batch), "rejected": len(failed),
+                "errors": sorted({str(write_error.details.get("errmsg")) for write_error in failed.values()})[:5]
+            }})
+        except Exception as error:
+            logger.error("buffered write failed", exc_info=error,
+                         extra={"fields": {"collection": self.collection.name, "objects": len(batch)}})
+            failed = {index: error for index in range(len(batch))}
+        if failed:
+            BUFFERED_WRITES_FAILED.inc(len(failed), collection=self.collection.name)
+        if self.on_written is not None and len(failed) < len(batch):
+            try:
+                self.on_written([object_dict for index, (object_dict, _) in enumerate(batch) if index not in failed])
+            except Exception:
+                logger.exception("handling of buffered write failed",
+                                 extra={"fields": {"collection": self.collection.name}})
+        for index, (_, future) in enumerate(batch):
+            if index in failed:
+                future.set_exception(failed[index])
+            else:
+                future.set_result(None)
+
+    def flush(self) -> None:
+        """
+        Writes all waiting objects immediately, in the calling thread
+        @return: None
+        """
+        while True:
+            with self._condition:
+                batch = self._take_batch()
+            if not batch:
+                return
+            self._write(batch)
+
+    def close(self) -> None:
+        """
+        Writes all waiting objects and stops the writer thread
+        @return: None
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._writer.join()
+        self.flush()
+
 
 class Database:
     """
     Class representing database connection
     """
-    def __init__(self):
+    _shared = None          # process-wide instance returned by Database.shared()
+    _shared_lock = threading.Lock()
+
+    def __init__(self, client: MongoClient | None = None):
         """
-           On creation object communicates with remote database using informations contained in mongodb-login file.
-           The file should contain name of the mongodb cluster, login and password, each on separate line
+           On creation object communicates with database given by MONGO_URI, or if it is not set, with remote
+           database using informations contained in mongodb-login file.
+           The file should contain name of the mongodb cluster, login and password, each on separate line.
+           If client is given, object uses it instead and leaves closing it to the owner
         """
-        with open("mongodb-login", 'r') as file:
-            _cluster = file.readline()[:-1]
-            _login = file.readline()[:-1]
-            _password = file.readline()[:-1]
-
-        uri = f"mongodb+srv://{_login}:{_password}@{_cluster}.mongodb.net/?retryWrites=true&w=majority&appName=praktyki0"
-        self.client = MongoClient(uri, server_api=ServerApi('1'))
-        self.database = self.client.get_database("praktyki_app_db")
+        self._owns_client = client is None
+        self.client = Database.create_client() if client is None else client
+        self.database = self.client.get_database(DATABASE_NAME)
+        self._buffers = {}  # collection name: WriteBuffer
+        self._buffers_lock = threading.Lock()
 
     def __del__(self) -> None:
         """
-        On deletion object closes connection to database
+        On deletion object closes connection to database, if it was the one that opened it
         @return: None
         """
-        if hasattr(self, 'client'):
+        if getattr(self, '_owns_client', False) and hasattr(self, 'client'):
             self.client.close()
 
-    def list_all(self, collection_name: str) -> list[dict]:
+    @staticmethod
+    def create_client() -> MongoClient:
+        """
+        Creates new client with its own connection pool. Client does not connect until first operation,
+        so it is safe to create it before the server forks workers.
+        With MONGO_URI set to "mongomock://" it returns in-memory stand-in instead, which requires mongomock package.
+        Its data lives in the process, so it is meant for benchmarks and local runs in threaded mode only
+        @return: MongoClient configured with pool settings from source.utils
+        """
+        if MONGO_URI is not None and MONGO_URI.startswith("mongomock://"):
+            import mongomock
+            logger.warning("using in-memory mongomock database, data is lost on exit")
+            return mongomock.MongoClient()
+
+        options = {}
+        if MONGO_URI is not None:
+            uri = MONGO_URI
+        else:
+            with open("mongodb-login", 'r') as file:
+                _cluster = file.readline()[:-1]
+                _login = file.readline()[:-1]
+                _password = file.readline()[:-1]
+            uri = f"mongodb+srv://{_login}:{_password}@{_cluster}.mongodb.net/?retryWrites=true&w=majority&appName=praktyki0"
+            options["server_api"] = ServerApi('1')
+        return MongoClient(
+            uri,
+            **options,
+            connect=False,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            heartbeatFrequencyMS=MONGO_HEARTBEAT_MS,
+            serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+            connectTimeoutMS=MONGO_TIMEOUT_MS,
+            event_listeners=[command_logger]
+        )
+
+    @classmethod
+    def shared(cls) -> Database:
+        """
+        Returns database object shared by every request handled in this process.
+        It is created lazily on first use and recreated in child processes after fork,
+        because MongoClient cannot be safely used across fork
+        @return: shared Database object
+        """
+        if cls._shared is None:
+            with cls._shared_lock:
+                if cls._shared is None:
+                    cls._shared = cls()
+        return cls._shared
+
+    @classmethod
+    def flush_shared(cls) -> None:
+        """
+        Writes everything waiting in write buffers of the shared object, if it exists. Called on shutdown
+        @return: None
+        """
+        if cls._shared is not None:
+            cls._shared.close_buffers()
+
+    @classmethod
+    def _reset_after_fork(cls) -> None:
+        """
+        Drops shared object inherited from parent process, child creates its own on first use.
+        Inherited client is not closed, its sockets still belong to the parent
+        @return: None
+        """
+        if cls._shared is not None:
+            cls._shared._owns_client = False
+            cls._shared._buffers = {}   # writer threads do not survive fork, objects queued in parent are its own
+        cls._shared = None
+        cls._shared_lock = threading.Lock()
+
+    def ping(self) -> bool:
+        """
+        Checks if database server is reachable
+        @return: True if server answered ping, False otherwise
+        """
+        try:
+            self.client.admin.command("ping")
+        except pymongo.errors.PyMongoError as error:
+            logger.warning("database ping failed", extra={"fields": {"error": str(error)}})
+            return False
+        return True
+
+    @timed(DB_LATENCY, operation="list_all")
+    def list_all(self, collection_name: str, projection: dict | None = None) -> list[dict]:
         """
         Lists all entries in a collection, mostly for test purposes
         :param collection_name: name of collection from database
+        :param projection: optional fields to include (field: 1) or exclude (field: 0), None returns all fields
         :return: string of all entries in bson format, hard to read for humans
         """
         collection = self.database.get_collection(collection_name)
-        cursor = collection.find({})
+        cursor = collection.find({}, projection)
         records = [record for record in cursor]
         return records
 
-    def search_one(self, collection_name: str, query: dict) -> dict:
+    def list_page(self, collection_name: str, limit: int, after: ObjectId | None = None,
+                  query: dict | None = None, projection: dict | None = None) -> list[dict]:
+        """
+        Lists one page of entries in a collection, see iter_page
+        @return: list of entries on the page
+        """
+        return list(self.iter_page(collection_name, limit, after, query, projection))
+
+    def iter_page(self, collection_name: str, limit: int, after: ObjectId | None = None,
+                  query: dict | None = None, projection: dict | None = None) -> Iterator[dict]:
+        """
+        Iterates over one page of entries in a collection, newest first. Pages are chained by _id of the last entry
+        (keyset pagination), so fetching a page costs the same no matter how deep into the collection it is
+        @param collection_name: name of collection from database
+        @param limit: maximum number of entries on the page
+        @param after: _id of the last entry of previous page, None for the first page
+        @param query: optional query to filter entries - dict consisting of key: value pairs
+        @param projection: optional fields to include (field: 1) or exclude (field: 0), None returns all fields
+        @return: iterator over entries on the page, documents are fetched in batches while iterating,
+                 time spent fetching them is recorded in DB_LATENCY
+        """
+        collection = self.database.get_collection(collection_name)
+        query = dict(query or {})
+        if after is not None:
+            query["_id"] = {"$lt": after}
+        cursor = collection.find(query, projection).sort("_id", pymongo.DESCENDING).limit(limit)
+        return timed_iter(DB_LATENCY, cursor, operation="iter_page")
+
+    def iter_page_by(self, collection_name: str, field: str, limit: int, after: tuple | None = None,
+                     query: dict | None = None, projection: dict | None = None) -> Iterator[dict]:
+        """
+        Iterates over one page of objects, newest first by given field, with _id breaking ties.
+        Uses keyset pagination like iter_page, fast with index on (query fields, field, _id)
+        @param collection_name: name of the collection to read
+        @param field: name of the field objects are ordered by, e.g. "date_created"
+        @param limit: maximum number of objects on the page
+        @param after: (value of field, _id) of the last object of previous page, None for the first page
+        @param query: optional filter applied before pagination
+        @param projection: optional fields to include (field: 1) or exclude (field: 0), None returns all fields
+        @return: iterator over objects on the page, documents are read from database while iterating,
+                 time spent reading them is recorded in DB_LATENCY
+        """
+        collection = self.database.get_collection(collection_name)
+        query = dict(query or {})
+        if after is not None:
+            value, object_id = after
+            query["$or"] = [{field: {"$lt": value}}, {field: value, "_id": {"$lt": object_id}}]
+        cursor = collection.find(query, projection).sort(
+            [(field, pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]).limit(limit)
+        return timed_iter(DB_LATENCY, cursor, operation="iter_page_by")
+
+    @timed(DB_LATENCY, operation="search_one")
+    def search_one(self, collection_name: str, query: dict, projection: dict | None = None) -> dict:
         """
         searches for one instance of query in collection collection_name
         @param collection_name: name of the collection to search, str
         @param query: query to search - dict consisting of key: value pairs
+        @param projection: optional fields to include (field: 1) or exclude (field: 0), None returns all fields
         @return: dict with all attributes of an object satisfying query result,
                 or empty dictionary if query was unsuccessful
         """
         collection = self.database.get_collection(collection_name)
-        return collection.find_one(query)
+        return collection.find_one(query, projection)
 
-    def search_all(self, collection_name: str, query: dict) -> list[dict]:
+    @timed(DB_LATENCY, operation="search_all")
+    def search_all(self, collection_name: str, query: dict, projection: dict | None = None,
+                   sort: list[tuple[str, int]] | None = None, limit: int = 0, skip: int = 0) -> list[dict]:
         """
         searches for all instances of query in collection collection_name
         @param collection_name: name of the collection to search, str
         @param query: query to search - dict consisting of key: value pairs
+        @param projection: optional fields to include (field: 1) or exclude (field: 0), None returns all fields
+        @param sort: optional list of (field, direction) pairs results are sorted by
+        @param limit: maximum number of results, 0 means no limit
+        @param skip: number of results to skip, applied after sorting
         @return: dict with all attributes of an object satisfying query result,
                 or empty dictionary if query was unsuccessful
         """
         results = []
         collection = self.database.get_collection(collection_name)
-        for result in collection.find(query):
+        cursor = collection.find(query, projection, skip=skip, limit=limit)
+        if sort:
+            cursor = cursor.sort(sort)
+        for result in cursor:
             results.append(result)
 
         return results
 
+    @timed(DB_LATENCY, operation="create_indexes")
+    def create_indexes(self, collection_name: str, indexes: list[pymongo.IndexModel]) -> None:
+        """
+        creates indexes in collection, indexes that already exist are left untouched
+        @param collection_name: name of the collection to index
+        @param indexes: list of index definitions
+        @return: None
+        """
+        if indexes:
+            collection = self.database.get_collection(collection_name)
+            collection.create_indexes(indexes)
+
+    @timed(DB_LATENCY, operation="count")
     def count(self, collection_name: str, query: dict) -> int:
         """
         counts all instances of query in collection collection_name
@@ -76,6 +372,65 @@ class Database:
         collection = self.database.get_collection(collection_name)
         return collection.count_documents(query)
 
+    @timed(DB_LATENCY, operation="count_grouped")
+    def count_grouped(self, collection_name: str, field: str, values: list) -> dict:
+        """
+        counts instances in collection collection_name for every given value of field, using single aggregation
+        @param collection_name: name of the collection to search, str
+        @param field: name of the field to group by, e.g. "article_id"
+        @param values: values of the field to count
+        @return: dict of value: number of objects with that value, values without any objects are mapped to 0
+        """
+        collection = self.database.get_collection(collection_name)
+        counts = {value: 0 for value in values}
+        pipeline = [
+            {"$match": {field: {"$in": list(counts)}}},
+            {"$group": {"_id": f"${field}", "count": {"$sum": 1}}}
+        ]
+        for group in collection.aggregate(pipeline):
+            counts[group["_id"]] = group["count"]
+        return counts
+
+    @timed(DB_LATENCY, operation="find_duplicates")
+    def find_duplicates(self, collection_name: str, field: str, limit: int = 10) -> list:
+        """
+        finds values of field shared by more than one object, e.g. before creating unique index on it
+        @param collection_name: name of the collection to search, str
+        @param field: name of the field
+        @param limit: maximum number of returned values
+        @return: list of duplicated values, empty if every value is unique
+        """
+        collection = self.database.get_collection(collection_name)
+        pipeline = [
+            {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+            {"$limit": limit}
+        ]
+        return [group["_id"] for group in collection.aggregate(pipeline, allowDiskUse=True)]
+
+    @timed(DB_LATENCY, operation="search_text")
+    def search_text(self, collection_name: str, query: str, projection: dict, limit: int, skip: int = 0) -> list[dict]:
+        """
+        finds objects matching full-text query with text index, best matches first, using single aggregation,
+        so projection can compute fields from large ones (e.g. cut text) before they are sent from database
+        @param collection_name: name of the collection with text index
+        @param query: words to search for, in MongoDB $text syntax
+        @param projection: fields to include (field: 1) or compute (field: expression), text score is in "score"
+        @param limit: maximum number of results
+        @param skip: number of best results to skip
+        @return: list of projected objects
+        """
+        collection = self.database.get_collection(collection_name)
+        pipeline = [
+            {"$match": {"$text": {"$search": query}}},
+            {"$sort": {"score": {"$meta": "textScore"}}},
+            {"$skip": skip},
+            {"$limit": limit},
+            {"$project": {**projection, "score": {"$meta": "textScore"}}}
+        ]
+        return list(collection.aggregate(pipeline))
+
+    @timed(DB_LATENCY, operation="random_one")
     def random_one(self, collection_name: str) -> dict:
         """
         retrieves random object from collection
@@ -85,6 +440,22 @@ class Database:
         collection = self.database.get_collection(collection_name)
         return list(collection.aggregate([{"$sample": {"size": 1}}]))[0]
 
+    @timed(DB_LATENCY, operation="sample")
+    def sample(self, collection_name: str, size: int, projection: dict | None = None) -> list[dict]:
+        """
+        retrieves random objects from collection with single aggregation
+        @param collection_name: name of the collection to retrieve sample from
+        @param size: number of objects to retrieve, collection with fewer objects returns all of them
+        @param projection: optional fields to include (field: 1), None returns all fields
+        @return: list of objects from the collection in dictionary key: value form
+        """
+        collection = self.database.get_collection(collection_name)
+        pipeline = [{"$sample": {"size": size}}]
+        if projection:
+            pipeline.append({"$project": projection})
+        return list(collection.aggregate(pipeline))
+
+    @timed(DB_LATENCY, operation="find_one_and_update")
     def find_one_and_update(self, collection_name: str, query: dict, update: dict) -> dict:
         """
         searches for one instance of query in collection and updates its values
@@ -96,6 +467,7 @@ class Database:
         collection = self.database.get_collection(collection_name)
         return collection.find_one_and_update(query, update)
 
+    @timed(DB_LATENCY, operation="insert")
     def insert(self, collection_name: str, object_dict: dict) -> None:
         """
         inserts one object into specified collection
@@ -105,3 +477,86 @@ class Database:
         """
         collection = self.database.get_collection(collection_name)
         collection.insert_one(object_dict)
+
+    def get_buffer(self, collection_name: str) -> WriteBuffer | None:
+        """
+        @param collection_name: name of the buffered collection
+        @return: write-behind buffer of the collection, None if it was not created yet
+        """
+        return self._buffers.get(collection_name)
+
+    def buffer(self, collection_name: str, on_written: callable = None) -> WriteBuffer:
+        """
+        Returns write-behind buffer of the collection, creating it on first use
+        @param collection_name: name of the collection buffered objects are inserted into
+        @param on_written: function called with every written batch, used only when the buffer is created
+        @return: WriteBuffer of the collection
+        """
+        if collection_name not in self._buffers:
+            with self._buffers_lock:
+                if collection_name not in self._buffers:
+                    collection = self.database.get_collection(collection_name)
+                    self._buffers[collection_name] = WriteBuffer(collection, WRITE_BUFFER_SIZE, WRITE_BUFFER_INTERVAL,
+                                                                 on_written)
+        return self._buffers[collection_name]
+
+    def close_buffers(self) -> None:
+        """
+        Writes everything waiting in write buffers and stops them
+        @return: None
+        """
+        with self._buffers_lock:
+            buffers, self._buffers = self._buffers, {}
+        for write_buffer in buffers.values():
+            write_buffer.close()
+
+    @timed(DB_LATENCY, operation="insert_many")
+    def insert_many(self, collection_name: str, objects: list[dict], ordered: bool = False) -> list[dict]:
+        """
+        inserts many objects into specified collection with one request
+        @param collection_name: name of the collection you insert objects into
+        @param objects: objects to insert, represented as key: value pairs
+        @param ordered: if False, objects failing to insert (e.g. duplicates) do not stop the rest
+        @return: inserted objects, without those database rejected
+        """
+        collection = self.database.get_collection(collection_name)
+        try:
+            collection.insert_many(objects, ordered=ordered)
+        except pymongo.errors.BulkWriteError as error:
+            if ordered:
+                # ordered insert stops at the first rejected object
+                return objects[:error.details["nInserted"]]
+            rejected = {write_error["index"] for write_error in error.details["writeErrors"]}
+            return [object_dict for index, object_dict in enumerate(objects) if index not in rejected]
+        return objects
+
+    @timed(DB_LATENCY, operation="replace_many")
+    def replace_many(self, collection_name: str, objects: list[dict]) -> None:
+        """
+        replaces objects with the same _id, or inserts them if they do not exist, with one request
+        @param collection_name: name of the collection
+        @param objects: whole objects including their _id
+        @return: None
+        """
+        if objects:
+            collection = self.database.get_collection(collection_name)
+            collection.bulk_write([pymongo.ReplaceOne({"_id": object_dict["_id"]}, object_dict, upsert=True)
+                                   for object_dict in objects], ordered=False)
+
+    @timed(DB_LATENCY, operation="increment_many")
+    def increment_many(self, collection_name: str, field: str, amounts: dict) -> None:
+        """
+        increments field of many objects with one request, objects that do not exist are not created
+        @param collection_name: name of the collection
+        @param field: name of the numeric field, e.g. "comment_count"
+        @param amounts: dict of _id: amount to add
+        @return: None
+        """
+        if amounts:
+            collection = self.database.get_collection(collection_name)
+            collection.bulk_write([pymongo.UpdateOne({"_id": object_id}, {"$inc": {field: amount}})
+                                   for object_id, amount in amounts.items()], ordered=False)
+
+
+os.register_at_fork(after_in_child=Database._reset_after_fork)
+atexit.register(Database.flush_shared)
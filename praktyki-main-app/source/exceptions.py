@@ -7,6 +7,14 @@ class NotLoggedInException(Exception):
         return self.message
 
 
+class NotFoundException(Exception):
+    def __init__(self, path: str):
+        self.message = f"There is no endpoint {path}"
+
+    def __str__(self) -> str:
+        return self.message
+
+
 class MethodNotAllowedException(Exception):
     def __init__(self, allowed: list[str] | str):
         if isinstance(allowed, str):
@@ -18,3 +26,18 @@ class MethodNotAllowedException(Exception):
     def __str__(self) -> str:
         return self.message
 
+
+class MigrationException(Exception):
+    def __init__(self, version: int, reason: str):
+        self.message = f"Migration {version} cannot be applied: {reason}"
+
+    def __str__(self) -> str:
+        return self.message
+
+
+class TooManyRequestsException(Exception):
+    def __init__(self, message: str = "Server is busy, try again later"):
+        self.message = message
+
+    def __str__(self) -> str:
+        return self.message
@@ -1,23 +1,25 @@
 import json
-import traceback
 from datetime import datetime
+from typing import Iterator
 
 import jwt.exceptions
+import pymongo
 from bson import ObjectId
+from bson.errors import InvalidId
 
 import source.exceptions as ex
+from source.collections.article_summaries import ArticleSummary
 from source.collections.users import User
 from source.collections.articles import Article
 from source.collections.comments import Comment
 from source.database import Database
-from source.utils import HTTP_STATUS, jsonify
+from source.logs import get_logger
+from source.seeding import Seeder
+from source.serializers import json_response, json_page_stream
+from source.utils import (HTTP_STATUS, PAGE_LIMIT_MAX, COMMENT_BUFFER, COMMENT_BUFFER_ACK,
+                          WRITE_BUFFER_ACK_TIMEOUT, SEARCH_SNIPPET_LENGTH, feed_cursor)
 
-
-# def access_method(func: callable, allowed: list[str], method: str):
-#     if method in allowed:
-#         return func
-#     else:
-#         raise ex.MethodNotAllowedException(allowed)
+logger = get_logger("handler")
 
 
 class Handler:
@@ -41,117 +43,217 @@ class Handler:
             status = HTTP_STATUS[401]
         elif isinstance(error, ex.NotLoggedInException):
             status = HTTP_STATUS[403]
+        elif isinstance(error, ex.NotFoundException):
+            status = HTTP_STATUS[404]
         elif isinstance(error, ex.MethodNotAllowedException):
             status = HTTP_STATUS[405]
+        elif isinstance(error, ex.TooManyRequestsException):
+            status = HTTP_STATUS[429]
         else:
             # response = b"An error has occurred"
             status = HTTP_STATUS[500]
-        traceback.print_exc()
-        # print(error.__traceback__, flush=True)
+            logger.exception("unhandled error", exc_info=error)
         return response, status
 
-    def insert_random_article(self) -> (bytes, str):
+    def insert_random_article(self, count: int = 1) -> (bytes, str):
         """
-        Insert random article to the collection
+        Insert random articles to the collection
+        @param count: number of articles to insert
         @return: tuple of byte encoded response, and status in string
         """
-        self.database.insert("articles", Article.create_random_article(self.database).json)
-        response = b"Inserted random article"
+        inserted = Seeder(self.database).articles(count)
+        response = f"Inserted {inserted} random article{'s' if inserted != 1 else ''}".encode()
         status = HTTP_STATUS[201]
         return response, status
 
-    def insert_random_comment(self) -> (bytes, str):
+    def insert_random_comment(self, count: int = 1) -> (bytes, str):
         """
-        Insert random article to the collection
+        Insert random comments to the collection
+        @param count: number of comments to insert
         @return: tuple of byte encoded response, and status in string
         """
-        self.database.insert("comments", Comment.create_random_comment(self.database).json)
-        response = b"Inserted random comment"
+        inserted = Seeder(self.database).comments(count)
+        response = f"Inserted {inserted} random comment{'s' if inserted != 1 else ''}".encode()
         status = HTTP_STATUS[201]
         return response, status
 
-    def insert_random_user(self) -> (bytes, str):
+    def insert_random_user(self, count: int = 1) -> (bytes, str):
         """
-        Insert random user to the collection
+        Insert random users to the collection
+        @param count: number of users to insert
         @return: tuple of byte encoded response, and status in string
         """
-        self.database.insert("users", User.add_random_user().json)
-        response = b"Inserted random user"
+        inserted = Seeder(self.database).users(count)
+        response = f"Inserted {inserted} random user{'s' if inserted != 1 else ''}".encode()
         status = HTTP_STATUS[201]
         return response, status
 
-    def get_article(self, get_input: dict) -> (bytes, str):
-        print(get_input, flush=True)
+    def get_article(self, get_input: dict, compact: bool = False, serializer: str | None = None) -> (bytes, str):
         article_id = ObjectId(get_input["id"][0])
         if "comms" in get_input:
             comm_nmbr = int(get_input["comms"][0])
         else:
             comm_nmbr = 10
+        comm_skip = int(get_input["skip"][0]) if "skip" in get_input else 0
+        if comm_nmbr < 0 or comm_skip < 0:
+            raise ValueError("Number of comments cannot be negative")
+        if comm_nmbr > PAGE_LIMIT_MAX:
+            raise ValueError(f"Number of comments cannot exceed {PAGE_LIMIT_MAX}")
 
         article = self.database.search_one("articles", {"_id": article_id})
         if article is None:
             return b"{}", HTTP_STATUS[204]
 
-        comments = self.database.search_all("comments", {"article_id": article_id})
-        comment_count = len(comments)
-        if len(comments) > comm_nmbr:
-            comments = comments[:comm_nmbr]
+        comments = []
+        if comm_nmbr > 0:
+            comments = self.database.search_all("comments", {"article_id": article_id},
+                                                sort=[("date_created", pymongo.ASCENDING)],
+                                                limit=comm_nmbr, skip=comm_skip)
+        comment_count = self.database.count("comments", {"article_id": article_id})
         article["comment_list"] = comments
         article["comment_count"] = comment_count
 
-        response = f"<pre>{jsonify(article)}</pre>".encode()
+        response = json_response(article, compact, serializer)
         status = HTTP_STATUS[200]
         return response, status
 
-    def get_articles(self) -> (bytes, str):
-        articles = self.database.list_all("articles")
+    def get_articles(self, limit: int, after: ObjectId | None, compact: bool = False,
+                     serializer: str | None = None) -> (Iterator[bytes], str):
+        articles = self.database.list_page("articles", limit, after)
+        summaries = self.database.search_all(ArticleSummary.collection,
+                                             {"_id": {"$in": [article["_id"] for article in articles]}},
+                                             {"comment_count": 1})
+        counts = {summary["_id"]: summary["comment_count"] for summary in summaries}
         for article in articles:
-            article["comment_count"] = self.database.count("comments", {"article_id": article.get("_id")})
-        response = f"<pre>{jsonify(articles)}</pre>".encode()
+            article["comment_count"] = counts.get(article["_id"], 0)
+        response = json_page_stream(articles, limit, compact, serializer)
         status = HTTP_STATUS[200]
         return response, status
 
-    def get_articles_textless(self) -> (bytes, str):
-        articles = self.database.list_all("articles")
+    def get_articles_textless(self, limit: int, after: ObjectId | None, compact: bool = False,
+                              serializer: str | None = None) -> (Iterator[bytes], str):
+        articles = self.database.iter_page(ArticleSummary.collection, limit, after)
+        response = json_page_stream(articles, limit, compact, serializer)
+        status = HTTP_STATUS[200]
+        return response, status
+
+    def search_articles(self, query: str, limit: int, skip: int, compact: bool = False,
+                        serializer: str | None = None) -> (bytes, str):
+        """
+        Finds articles matching the query with the text index, best matches first
+        @param query: words to search for, in MongoDB $text syntax (phrases in quotes, negation with -)
+        @param limit: number of results on the page
+        @param skip: number of best results to skip
+        @return: tuple of response with {"items": [...], "next": skip of next page or null}, and status in string
+        """
+        if Article.search_pattern(query) is None:
+            # query of only negated words or empty phrases matches nothing, database is not asked
+            return json_response({"items": [], "next": None}, compact, serializer), HTTP_STATUS[200]
+        articles = self.database.search_text("articles", query,
+                                             Article.search_projection(query, SEARCH_SNIPPET_LENGTH), limit, skip)
         for article in articles:
-            del article["text"]
-        response = f"<pre>{jsonify(articles)}</pre>".encode()
+            article["snippet"] = Article.snippet(article.pop("window", ""), query, SEARCH_SNIPPET_LENGTH,
+                                                 article.pop("window_start"), article.pop("text_length"))
+        response = json_response({"items": articles, "next": skip + limit if len(articles) == limit else None},
+                                 compact, serializer)
+        status = HTTP_STATUS[200]
+        return response, status
+
+    def get_users(self, limit: int, after: ObjectId | None, compact: bool = False,
+                  serializer: str | None = None) -> (Iterator[bytes], str):
+        users = self.database.iter_page("users", limit, after, projection=User.public_fields)
+        response = json_page_stream(users, limit, compact, serializer)
+        status = HTTP_STATUS[200]
+        return response, status
+
+    def get_user_articles(self, username: str, limit: int, after: tuple | None, compact: bool = False,
+                          serializer: str | None = None) -> (Iterator[bytes], str):
+        author = User.author(username, self.database)
+        articles = self.database.iter_page_by(ArticleSummary.collection, "date_created", limit, after,
+                                              query={"author.id": author["id"]})
+        response = json_page_stream(articles, limit, compact, serializer, cursor=feed_cursor)
         status = HTTP_STATUS[200]
         return response, status
 
-    def get_users(self) -> (bytes, str):
-        response = f"<pre>{jsonify(self.database.list_all("users"))}</pre>".encode()
+    def get_user_comments(self, username: str, limit: int, after: tuple | None, compact: bool = False,
+                          serializer: str | None = None) -> (Iterator[bytes], str):
+        author = User.author(username, self.database)
+        comments = self.database.iter_page_by("comments", "date_created", limit, after,
+                                              query={"author.id": author["id"]}, projection=Comment.feed_fields)
+        response = json_page_stream(comments, limit, compact, serializer, cursor=feed_cursor)
         status = HTTP_STATUS[200]
         return response, status
 
     def add_article(self, username: str, post_input: dict) -> (bytes, str):
-        user = self.database.search_one("users", {"username": username})
+        author = User.author(username, self.database)
         art = Article(
             post_input["title"],
             post_input["text"],
             datetime.now(),
-            user.get("_id"),
+            author["id"],
             username,
-            user.get("email")
+            author["email"]
         )
         self.database.insert("articles", art.json)
+        ArticleSummary.add(self.database, [art.json])
         response = b"Article added"
         status = HTTP_STATUS[201]
         return response, status
 
-    def add_comment(self, username: str, post_input: dict) -> (bytes, str):
-        user = self.database.search_one("users", {"username": username})
-        self.database.search_one("articles", {"_id": post_input["article_id"]})
-        #TODO check no id error
+    @staticmethod
+    def _comments_written(database: Database, written: callable = None) -> callable:
+        """
+        @return: function run with every written batch of buffered comments, counts them in article summaries
+                 and calls written
+        """
+        def comments_written(batch: list[dict]) -> None:
+            ArticleSummary.count_comments(database, batch)
+            if written is not None:
+                written(batch)
+        return comments_written
+
+    def add_comment(self, username: str, post_input: dict, written: callable = None) -> (bytes, str):
+        """
+        Adds comment, directly or through the write buffer if COMMENT_BUFFER is set
+        @param username: author of the comment
+        @param post_input: article_id, text and optional ack - False returns before the comment is written
+        @param written: function called with every batch of buffered comments once it is written,
+                        e.g. to invalidate cached responses, used only when the buffer is created
+        @return: tuple of byte encoded response, and status in string
+        """
+        author = User.author(username, self.database)
+        try:
+            article_id = ObjectId(post_input["article_id"])
+        except InvalidId:
+            raise ValueError("Invalid article id")
+        if self.database.search_one("articles", {"_id": article_id}, Article.id_field) is None:
+            raise ValueError(f"There is no article identified by {article_id}")
         comment = Comment(
-            ObjectId(post_input["article_id"]),
+            article_id,
             post_input["text"],
             datetime.now(),
-            user.get("_id"),
+            author["id"],
             username,
-            user.get("email")
+            author["email"]
         )
-        self.database.insert("comments", comment.json)
+        if not COMMENT_BUFFER:
+            self.database.insert("comments", comment.json)
+            ArticleSummary.count_comments(self.database, [comment.json])
+        else:
+            write_buffer = self.database.get_buffer("comments")
+            if write_buffer is None:
+                # callback is built once, with the buffer shared by all requests
+                write_buffer = self.database.buffer("comments", self._comments_written(self.database, written))
+            write = write_buffer.insert(comment.json)
+            if not post_input.get("ack", COMMENT_BUFFER_ACK):
+                # client opted out of waiting, comment will be written with the next batch
+                return b"Comment accepted", HTTP_STATUS[202]
+            try:
+                write.result(timeout=WRITE_BUFFER_ACK_TIMEOUT)
+            except TimeoutError:
+                # comment stays in the buffer and is written later, the client is told it is not written yet
+                logger.warning("buffered comment not written in time", extra={"fields": {"article_id": article_id}})
+                return b"Comment accepted, it will be visible once it is written", HTTP_STATUS[202]
         response = b"Comment added"
         status = HTTP_STATUS[201]
         return response, status
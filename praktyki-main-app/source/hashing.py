@@ -0,0 +1,102 @@
+from __future__ import annotations
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import source.exceptions as ex
+from source.metrics import HASH_LATENCY, Counter, Gauge, registry
+from source.utils import ASGI_THREADS, HASH_VERSIONS, HASH_VERSION, HASH_WORKERS, HASH_QUEUE_SIZE, SERVER_THREADS
+
+HASH_REJECTED = registry.register(Counter(
+    "password_hash_rejected_total", "Password hashing requests rejected because of full queue"))
+
+
+class PasswordHasher:
+    """
+    Runs password hashing in a dedicated pool of threads (hashlib releases GIL while hashing),
+    so a burst of logins cannot take over all request threads. When all workers are busy and
+    the queue is full, new requests are rejected instead of waiting. At most workers + queue_size requests
+    wait for hashing, which has to be fewer than request threads of the server, see check_request_threads
+    """
+    def __init__(self, workers: int, queue_size: int):
+        """
+        @param workers: number of threads hashing at the same time
+        @param queue_size: number of requests allowed to wait for a free worker
+        """
+        self.workers = workers
+        self.admitted = workers + queue_size    # requests hashing or waiting at the same time
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hash")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self.in_flight = 0      # requests being hashed or waiting in queue
+        self.hashed = 0         # number of finished hashes
+        self.rejected = 0       # number of requests rejected because of full queue
+        self.hash_time = 0.0    # total time spent hashing, in seconds
+        self.max_hash_time = 0.0
+
+    @staticmethod
+    def _hash(password: str, salt: bytes, version: int) -> (bytes, float):
+        algorithm, iterations = HASH_VERSIONS[version]
+        start = time.perf_counter()
+        hashed = hashlib.pbkdf2_hmac(algorithm, password.encode('utf-8'), salt, iterations)
+        return hashed, time.perf_counter() - start
+
+    def hash(self, password: str, salt: bytes, version: int = HASH_VERSION) -> bytes:
+        """
+        Hashes password with parameters of given version, blocks until hash is ready
+        @param password: password in plain text
+        @param salt: random salt stored with user
+        @param version: version of hashing parameters from HASH_VERSIONS
+        @return: hashed password
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            HASH_REJECTED.inc()
+            raise ex.TooManyRequestsException()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            hashed, elapsed = self.executor.submit(self._hash, password, salt, version).result()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+        with self._lock:
+            self.hashed += 1
+            self.hash_time += elapsed
+            self.max_hash_time = max(self.max_hash_time, elapsed)
+        HASH_LATENCY.observe(elapsed)
+        return hashed
+
+    def check_request_threads(self, threads: int) -> None:
+        """
+        Raises ValueError if hashing could hold all request threads of the server - they would block waiting
+        for hashes and the queue would never fill up to reject anything
+        @param threads: number of threads handling requests in one process
+        @return: None
+        """
+        if self.admitted >= threads:
+            raise ValueError(f"HASH_WORKERS + HASH_QUEUE_SIZE ({self.admitted}) needs to be lower than "
+                             f"number of request threads ({threads})")
+
+    def stats(self) -> dict:
+        """
+        @return: dict with current queue depth and hashing statistics
+        """
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "queue_depth": max(0, self.in_flight - self.workers),
+                "hashed": self.hashed,
+                "rejected": self.rejected,
+                "avg_hash_time": self.hash_time / self.hashed if self.hashed else 0.0,
+                "max_hash_time": self.max_hash_time,
+            }
+
+
+hasher = PasswordHasher(HASH_WORKERS, HASH_QUEUE_SIZE)
+hasher.check_request_threads(min(SERVER_THREADS, ASGI_THREADS))
+registry.register(Gauge("password_hash_queue_depth", "Password hashing requests waiting for a free worker",
+                        function=lambda: hasher.stats()["queue_depth"]))
@@ -0,0 +1,152 @@
+from __future__ import annotations
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+from source.metrics import Counter, registry
+from source.utils import LOG_LEVEL, LOG_QUEUE_SIZE, LOG_SUCCESS_SAMPLE_RATE
+
+LOG_RECORDS_DROPPED = registry.register(Counter(
+    "log_records_dropped_total", "Log records dropped because of full logging queue"))
+
+# id of the request being handled, attached to every log record written while handling it
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line. Additional fields are given as extra={"fields": {...}}
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that never blocks request threads - when queue is full, records are dropped and counted
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # arguments and traceback are rendered here, as objects they refer to can change before listener writes them,
+        # message and traceback are kept apart so the formatter can put them into separate fields
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+_listener = None
+
+
+def _start_listener() -> None:
+    """
+    Starts thread writing queued records to stdout
+    """
+    global _listener
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(_handler.queue, output)
+    _listener.start()
+
+
+def _restart_after_fork() -> None:
+    """
+    Child process gets a new queue and listener thread - thread of the parent does not exist there,
+    records queued by the parent would be written twice, and lock of the queue may have been copied while held
+    """
+    _handler.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _start_listener()
+
+
+def shutdown_logging() -> None:
+    """
+    Writes records left in the queue and stops the background thread. Runs at exit, and must be called
+    by processes leaving with os._exit, which skips exit handlers
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.flush()
+        _listener = None
+
+
+def setup_logging() -> None:
+    """
+    Routes records of all application loggers through in-memory queue, so writing to stdout
+    happens in a background thread instead of request threads
+    """
+    logger = logging.getLogger("praktyki")
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    _handler.addFilter(RequestIdFilter())
+    logger.addHandler(_handler)
+    _start_listener()
+    os.register_at_fork(after_in_child=_restart_after_fork)
+    atexit.register(shutdown_logging)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    @param name: name of the module, e.g. "app"
+    @return: logger of the application module
+    """
+    return logging.getLogger(f"praktyki.{name}")
+
+
+def log_request(logger: logging.Logger, method: str, route: str, status: str, duration: float) -> None:
+    """
+    Writes access log record of handled request. Errors are always logged, successful requests
+    only with probability LOG_SUCCESS_SAMPLE_RATE, as they are the bulk of the log
+    """
+    code = int(status.split(" ", 1)[0])
+    if code >= 500:
+        level = logging.ERROR
+    elif code >= 400:
+        level = logging.WARNING
+    elif random.random() < LOG_SUCCESS_SAMPLE_RATE:
+        level = logging.INFO
+    else:
+        return
+    logger.log(level, "request handled", extra={"fields": {
+        "method": method, "route": route, "status": code, "duration_ms": round(duration * 1000, 2)
+    }})
+
+
+setup_logging()
@@ -0,0 +1,230 @@
+from __future__ import annotations
+import abc
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+# upper bounds of latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    @abc.abstractmethod
+    def samples(self) -> list[str]:
+        """
+        @return: lines of exposition format with current values, one per combination of labels
+        """
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """
+    Gauge set by the application, or read from a function every time metrics are collected
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), function: callable = None):
+        super().__init__(name, description, labels)
+        self._values = {}
+        self.function = function
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def samples(self) -> list[str]:
+        if self.function is not None:
+            return [f"{self.name} {self.function()}"]
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        self._values = {}   # labels: [count in every bucket..., sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            values = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Measures time spent in the with block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            for key, values in self._values.items():
+                for bound, count in zip(self.buckets, values):
+                    bucket = _format_labels(self.labels, key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{bucket} {count}")
+                bucket = _format_labels(self.labels, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{bucket} {values[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {values[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {values[-1]}")
+        return lines
+
+
+class Registry:
+    """
+    Collection of metrics of the process, rendered in Prometheus text format
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = Registry()
+REQUEST_LATENCY = registry.register(Histogram(
+    "http_request_duration_seconds", "Time from receiving request to sending last byte of response", ("route",)))
+REQUESTS = registry.register(Counter(
+    "http_requests_total", "Number of handled requests", ("route", "status")))
+REQUESTS_IN_FLIGHT = registry.register(Gauge(
+    "http_requests_in_flight", "Number of requests being handled"))
+DB_LATENCY = registry.register(Histogram(
+    "db_operation_duration_seconds", "Time spent in Database calls", ("operation",)))
+JWT_LATENCY = registry.register(Histogram(
+    "jwt_verification_duration_seconds", "Time spent verifying signature of login tokens"))
+HASH_LATENCY = registry.register(Histogram(
+    "password_hash_duration_seconds", "Time spent hashing passwords"))
+
+
+def timed(histogram: Histogram, **labels) -> callable:
+    """
+    Decorator measuring time spent in decorated function
+    @param histogram: histogram the time is recorded in
+    @param labels: labels of the recorded time
+    @return: decorator
+    """
+    def decorator(func: callable) -> callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(histogram: Histogram, iterable: Iterable, **labels) -> Iterator:
+    """
+    Yields items of iterable, e.g. database cursor, and records time spent fetching them - time the consumer
+    spends between items is not counted. Time is recorded when iteration ends or the generator is closed
+    @param histogram: histogram the time is recorded in
+    @param iterable: iterable to time
+    @param labels: labels of the recorded time
+    @return: generator of items of iterable
+    """
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        histogram.observe(elapsed, **labels)
+
+
+class MetricsMiddleware:
+    """
+    WSGI middleware recording latency, status and number of in-flight requests of the wrapped application
+    """
+    def __init__(self, app: callable, route_name: callable):
+        """
+        @param app: WSGI application to wrap
+        @param route_name: function naming route of request path, e.g. Router.route_name - requests to unknown
+                           paths are recorded as "other", so random paths cannot create unlimited number of labels
+        """
+        self.app = app
+        self.route_name = route_name
+
+    def __call__(self, environ: dict, start_response: callable):
+        path = environ.get('PATH_INFO', '')
+        route = self.route_name(path)
+        status = {}
+
+        def recording_start_response(response_status: str, headers: list, exc_info=None):
+            status["code"] = response_status.split(" ", 1)[0]
+            return start_response(response_status, headers, exc_info)
+
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            yield from self.app(environ, recording_start_response)
+        finally:
+            REQUEST_LATENCY.observe(time.perf_counter() - start, route=route)
+            REQUESTS.inc(route=route, status=status.get("code", "000"))
+            REQUESTS_IN_FLIGHT.dec()
@@ -0,0 +1,158 @@
+"""
+Versioned database bootstrap. Every migration is applied once, in order of versions,
+and the number of the last applied one is stored in the 'schema_migrations' collection.
+Migrations only create things that do not exist yet, so running them again is harmless.
+
+Usage:  python -m source.migrations             applies pending migrations
+        python -m source.migrations --explain   also prints query plans of the hot queries
+        python -m source.migrations --rebuild-summaries   also recomputes all article summaries
+"""
+import sys
+
+import pymongo
+from bson import ObjectId
+
+import source.exceptions as ex
+
+from source.collections.article_summaries import ArticleSummary
+from source.database import Database
+from source.logs import get_logger
+
+MIGRATIONS_COLLECTION = "schema_migrations"
+logger = get_logger("migrations")
+
+
+def _indexes_v1(database: Database) -> None:
+    """
+    Indexes used by login, registration and get_article. Unique indexes cannot be built over duplicated
+    values (e.g. usernames generated twice by Faker), those users need to be removed or renamed first
+    """
+    for field in ("username", "email"):
+        duplicates = database.find_duplicates("users", field)
+        if duplicates:
+            raise ex.MigrationException(1, f"users share the same {field}, remove or rename them first: "
+                                           f"{', '.join(map(str, duplicates))}")
+    database.create_indexes("users", [
+        pymongo.IndexModel([("username", pymongo.ASCENDING)], unique=True),
+        pymongo.IndexModel([("email", pymongo.ASCENDING)], unique=True),
+    ])
+    database.create_indexes("comments", [
+        # comments of an article in order they were written
+        pymongo.IndexModel([("article_id", pymongo.ASCENDING), ("date_created", pymongo.ASCENDING)]),
+    ])
+
+
+def _text_index_v2(database: Database) -> None:
+    """
+    Full-text index used by search_articles, matches in title weigh more than matches in text
+    """
+    database.create_indexes("articles", [
+        pymongo.IndexModel([("title", pymongo.TEXT), ("text", pymongo.TEXT)],
+                           weights={"title": 10, "text": 1}, default_language="english", name="articles_text"),
+    ])
+
+
+def _article_summaries_v3(database: Database) -> None:
+    """
+    Backfills summaries of articles written before they were maintained
+    """
+    ArticleSummary.rebuild(database)
+
+
+def _author_indexes_v4(database: Database) -> None:
+    """
+    Indexes used by listings of articles and comments of one user, newest first
+    """
+    author_feed = [("author.id", pymongo.ASCENDING), ("date_created", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
+    database.create_indexes("article_summaries", [pymongo.IndexModel(author_feed)])
+    database.create_indexes("comments", [pymongo.IndexModel(author_feed)])
+
+
+# (version, description, function applying the migration), ordered by version
+MIGRATIONS = [
+    (1, "indexes on users.username, users.email and comments.article_id", _indexes_v1),
+    (2, "text index on articles.title and articles.text", _text_index_v2),
+    (3, "backfill of article_summaries", _article_summaries_v3),
+    (4, "indexes on author.id and date_created of article_summaries and comments", _author_indexes_v4),
+]
+
+
+def current_version(database: Database) -> int:
+    """
+    @param database: database connection object
+    @return: version of the last applied migration, 0 if none was applied
+    """
+    state = database.search_one(MIGRATIONS_COLLECTION, {"_id": "schema"})
+    return state.get("version", 0) if state else 0
+
+
+def migrate(database: Database) -> list[int]:
+    """
+    Applies all migrations newer than the current schema version
+    @param database: database connection object
+    @return: list of versions that were applied
+    """
+    version = current_version(database)
+    applied = []
+    for number, description, apply in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info("applying migration", extra={"fields": {"version": number, "description": description}})
+        apply(database)
+        database.database.get_collection(MIGRATIONS_COLLECTION).update_one(
+            {"_id": "schema"}, {"$max": {"version": number}}, upsert=True
+        )
+        applied.append(number)
+    return applied
+
+
+def _plan_stages(plan: dict) -> str:
+    """
+    Flattens winning plan of a query into readable chain of stages, e.g. "LIMIT <- FETCH <- IXSCAN(name_1)"
+    """
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if "indexName" in plan:
+            stage += f"({plan['indexName']})"
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " <- ".join(stages)
+
+
+def explain_hot_queries(database: Database) -> dict[str, str]:
+    """
+    Asks database how it executes the queries application runs most often
+    @param database: database connection object
+    @return: dict of query name: chain of stages of its winning plan
+    """
+    db = database.database
+    queries = {
+        "login by username": db.users.find({"username": ""}).limit(1),
+        "login by email": db.users.find({"email": ""}).limit(1),
+        "comments of article": db.comments.find({"article_id": ObjectId()})
+                                 .sort("date_created", pymongo.ASCENDING).limit(10),
+        "comment count of article": db.comments.find({"article_id": ObjectId()}),
+        "page of articles": db.articles.find({"_id": {"$lt": ObjectId()}})
+                              .sort("_id", pymongo.DESCENDING).limit(50),
+        "page of article summaries": db.article_summaries.find({"_id": {"$lt": ObjectId()}})
+                                       .sort("_id", pymongo.DESCENDING).limit(50),
+        "page of user's articles": db.article_summaries.find({"author.id": ObjectId()})
+                                     .sort([("date_created", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+                                     .limit(50),
+        "page of user's comments": db.comments.find({"author.id": ObjectId()})
+                                     .sort([("date_created", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+                                     .limit(50),
+    }
+    return {name: _plan_stages(cursor.explain()["queryPlanner"]["winningPlan"]) for name, cursor in queries.items()}
+
+
+if __name__ == "__main__":
+    db = Database.shared()
+    print(f"Schema version: {current_version(db)}")
+    print(f"Applied migrations: {migrate(db) or 'none'}")
+    if "--rebuild-summaries" in sys.argv[1:]:
+        print(f"Rebuilt article summaries: {ArticleSummary.rebuild(db)}")
+    if "--explain" in sys.argv[1:]:
+        for query, plan in explain_hot_queries(db).items():
+            print(f"{query}: {plan}")
@@ -0,0 +1,180 @@
+from __future__ import annotations
+import contextvars
+import cProfile
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+from source.logs import get_logger
+from source.utils import PROFILE_SAMPLE_RATE, PROFILE_ALLOW_HEADER, PROFILE_DIR, PROFILE_MODE, PROFILE_INTERVAL
+
+# commands sent to MongoDB while handling currently profiled request, None when request is not profiled
+current_commands = contextvars.ContextVar("current_commands", default=None)
+
+logger = get_logger("profiling")
+
+
+def query_shape(value):
+    """
+    Replaces values in query with "?", leaving field names and operators, so queries differing only
+    in values look the same, e.g. {"article_id": "?"}
+    """
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [query_shape(item) for item in value[:1]]
+    return "?"
+
+
+class CommandLogger(monitoring.CommandListener):
+    """
+    Records MongoDB commands sent while handling profiled requests - their shape, duration and number of
+    returned documents. Commands sent outside of profiled requests are ignored at the cost of one lookup
+    """
+    _shaped_fields = ("filter", "query", "pipeline", "sort", "projection", "updates", "q")
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        commands = current_commands.get()
+        if commands is None:
+            return
+        shape = {key: query_shape(value) for key, value in event.command.items() if key in self._shaped_fields}
+        collection = event.command.get(event.command_name)
+        commands[event.request_id] = {"command": event.command_name, "collection": collection, "shape": shape}
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        commands = current_commands.get()
+        if commands is None or event.request_id not in commands:
+            return
+        reply = event.reply
+        cursor = reply.get("cursor", {})
+        documents = len(cursor.get("firstBatch", cursor.get("nextBatch", []))) if cursor else reply.get("n", 0)
+        commands[event.request_id].update(duration_ms=event.duration_micros / 1000, documents=documents)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        commands = current_commands.get()
+        if commands is None or event.request_id not in commands:
+            return
+        commands[event.request_id].update(duration_ms=event.duration_micros / 1000, error=str(event.failure))
+
+
+class StackSampler:
+    """
+    Samples call stack of one thread every interval seconds, and counts identical stacks.
+    Result is written in collapsed format ("outer;inner;innermost count") read by flame graph tools
+    """
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def dump(self, path: str) -> None:
+        with open(path, "w") as file:
+            for stack, count in self.stacks.items():
+                file.write(f"{stack} {count}\n")
+
+
+class ProfilingMiddleware:
+    """
+    WSGI middleware profiling sampled requests. Request is profiled with probability PROFILE_SAMPLE_RATE,
+    or on demand with "X-Profile: 1" header if PROFILE_ALLOW_HEADER is set. Profile of every such request
+    is saved in PROFILE_DIR - cProfile stats (.prof) or sampled stacks for flame graphs (.folded),
+    and MongoDB commands it sent are logged. Under ASGI profiled responses are not streamed
+    """
+    _cprofile_lock = threading.Lock()   # only one cProfile profiler can be active in the process at a time
+
+    def __init__(self, app: callable, route_name: callable):
+        self.app = app
+        self.route_name = route_name
+
+    def _should_profile(self, environ: dict) -> bool:
+        if PROFILE_ALLOW_HEADER and environ.get('HTTP_X_PROFILE') == "1":
+            return True
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    def __call__(self, environ: dict, start_response: callable):
+        if not self._should_profile(environ):
+            return self.app(environ, start_response)
+        if environ.get("praktyki.resumed_in_threads"):
+            # ASGI resumes response iterator in whichever thread of the pool is free, so the profile would follow
+            # wrong thread and current_commands could not be reset - whole response is produced in one call instead
+            with self._profiling(environ.get('PATH_INFO', '')):
+                return list(self.app(environ, start_response))
+        return self._profiled(environ, start_response)
+
+    def _profiled(self, environ: dict, start_response: callable):
+        with self._profiling(environ.get('PATH_INFO', '')):
+            yield from self.app(environ, start_response)
+
+    @contextmanager
+    def _profiling(self, path: str):
+        """
+        Profiles code run in the current thread until the block ends, then saves the profile
+        @param path: path of the profiled request
+        """
+        route = self.route_name(path)
+        commands = {}
+        token = current_commands.set(commands)
+        profiler = sampler = None
+        if PROFILE_MODE == "stacks":
+            sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL)
+            sampler.start()
+        elif self._cprofile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                self._cprofile_lock.release()
+            if sampler is not None:
+                sampler.stop()
+            current_commands.reset(token)
+            self._save(route, elapsed, profiler, sampler, commands)
+
+    @staticmethod
+    def _save(route: str, elapsed: float, profiler: cProfile.Profile | None, sampler: StackSampler | None,
+              commands: dict) -> None:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = route.strip("/").replace("/", "_").replace("<", "").replace(">", "") or "index"
+        timestamp = time.strftime('%Y%m%d-%H%M%S')
+        base = os.path.join(PROFILE_DIR, f"{name}-{timestamp}-{os.getpid()}-{threading.get_ident()}")
+        if profiler is not None:
+            profiler.dump_stats(f"{base}.prof")
+        if sampler is not None:
+            sampler.dump(f"{base}.folded")
+        logger.info("request profiled", extra={"fields": {
+            "route": route, "duration_ms": round(elapsed * 1000, 1), "profile": base,
+            "commands": list(commands.values())
+        }})
+
+
+command_logger = CommandLogger()
@@ -0,0 +1,109 @@
+"""
+Token-bucket rate limiting of expensive routes. Every client (IP address, or username on routes requiring login)
+has a bucket of `burst` tokens per budget, refilled with `rate` tokens per second. Request takes one token,
+or as many as the route charges for it (e.g. one per seeded document), and is rejected with 429 when the bucket
+does not have them, before the route does any work. Login routes also have a bucket of the posted username,
+so guessing passwords of one account from many addresses is limited too
+"""
+from __future__ import annotations
+import threading
+import time
+from collections import OrderedDict
+
+from source.logs import get_logger
+from source.metrics import Counter, registry
+from source.utils import RATE_LIMIT, RATE_LIMIT_BACKEND, RATE_LIMIT_SHARDS, RATE_LIMIT_KEYS, CACHE_REDIS_URL
+
+RATE_LIMITED = registry.register(Counter(
+    "rate_limited_requests_total", "Requests rejected because client exceeded its budget", ("budget",)))
+RATE_LIMIT_ERRORS = registry.register(Counter(
+    "rate_limit_errors_total", "Requests let through without rate limiting because Redis could not be reached"))
+
+logger = get_logger("ratelimit")
+
+
+class LocalRateLimiter:
+    """
+    Buckets kept in memory of the process. They are split into shards with their own locks,
+    so concurrent requests of different clients rarely wait for each other.
+    Every shard keeps at most max_keys buckets, least recently used are dropped (as if they were full)
+    """
+    def __init__(self, shards: int, max_keys: int):
+        self.max_keys = max_keys
+        self._shards = [(threading.Lock(), OrderedDict()) for _ in range(shards)]
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1) -> float:
+        """
+        Takes tokens from the bucket of key
+        @param key: client and budget, e.g. "login:127.0.0.1"
+        @param rate: tokens added to the bucket every second
+        @param burst: capacity of the bucket
+        @param cost: number of tokens to take, at most burst
+        @return: 0 if tokens were taken, otherwise seconds until enough tokens are available
+        """
+        lock, buckets = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+        with lock:
+            tokens, updated = buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0.0
+            else:
+                wait = (cost - tokens) / rate
+            buckets[key] = (tokens, now)
+            if len(buckets) > self.max_keys:
+                buckets.popitem(last=False)
+        return wait
+
+
+class RedisRateLimiter:
+    """
+    Buckets shared by all workers and servers, kept in Redis and updated atomically by a Lua script.
+    Time is read from Redis, so clocks of the servers do not need to agree. When Redis cannot be reached,
+    requests are let through (fail open) and a warning is logged - limiting is a protection, not a reason
+    to stop serving. Requires redis package
+    """
+    # KEYS[1] bucket, ARGV: rate, burst, cost; returns seconds to wait as string, "0" if tokens were taken
+    SCRIPT = """
+    local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    redis.replicate_commands()  -- needed before TIME by Redis older than 5, no-op in newer ones
+    local time = redis.call("TIME")
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+    local tokens, updated = tonumber(bucket[1]) or burst, tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+    redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+    redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str, prefix: str = "praktyki:ratelimit:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._script = self.client.register_script(self.SCRIPT)
+        self._errors = redis.RedisError
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1) -> float:
+        try:
+            return float(self._script(keys=[self.prefix + key], args=[rate, burst, cost]))
+        except self._errors as error:
+            RATE_LIMIT_ERRORS.inc()
+            logger.warning("rate limiter unavailable, request is let through", extra={"fields": {
+                "key": key, "error": str(error)
+            }})
+            return 0.0
+
+
+def create_rate_limiter() -> LocalRateLimiter | RedisRateLimiter | None:
+    """
+    Creates rate limiter with backend selected by RATE_LIMIT_BACKEND setting, None if rate limiting is disabled
+    """
+    if not RATE_LIMIT:
+        return None
+    if RATE_LIMIT_BACKEND == "redis":
+        return RedisRateLimiter(CACHE_REDIS_URL)
+    return LocalRateLimiter(RATE_LIMIT_SHARDS, RATE_LIMIT_KEYS)
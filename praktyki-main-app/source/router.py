@@ -0,0 +1,258 @@
+from __future__ import annotations
+import json
+import math
+import re
+from urllib import parse
+
+import source.exceptions as ex
+from source.cache import ResponseCache
+from source.ratelimit import RATE_LIMITED, LocalRateLimiter, RedisRateLimiter
+from source.utils import HTTP_STATUS, RATE_LIMITS, RATE_LIMIT_TRUST_PROXY
+
+
+class Request:
+    """
+    HTTP request passed to route functions
+    """
+    def __init__(self, environ: dict):
+        self.environ = environ
+        self.path = environ['PATH_INFO']
+        self.method = environ['REQUEST_METHOD']
+        self.get_input = parse.parse_qs(environ.get('QUERY_STRING', ''))
+        self.username = None    # set by router for routes requiring authentication
+        self.path_params = {}   # values of <parameters> in path of the route, set by router
+        self.content_type = "text/html; charset=utf-8"     # content type of successful response, set by router
+        self.response_headers = []      # additional headers of the response, e.g. ETag
+        self._post_input = None
+
+    @property
+    def client_ip(self) -> str:
+        """
+        Address of the client, taken from X-Forwarded-For header if the application runs behind trusted proxy
+        """
+        if RATE_LIMIT_TRUST_PROXY and self.environ.get('HTTP_X_FORWARDED_FOR'):
+            return self.environ['HTTP_X_FORWARDED_FOR'].split(",")[0].strip()
+        return self.environ.get('REMOTE_ADDR', '')
+
+    @property
+    def compact(self) -> bool:
+        """
+        True if client asked for plain JSON (API clients) instead of readable JSON embedded in HTML
+        """
+        return "application/json" in self.environ.get('HTTP_ACCEPT', '')
+
+    @property
+    def serializer(self) -> str | None:
+        """
+        Name of JSON serializer requested with Accept header parameter, e.g. "application/json; serializer=bson",
+        None if client did not ask for any
+        """
+        for media_range in self.environ.get('HTTP_ACCEPT', '').split(","):
+            for param in media_range.split(";")[1:]:
+                name, _, value = param.partition("=")
+                if name.strip() == "serializer":
+                    return value.strip()
+        return None
+
+    @property
+    def post_input(self) -> dict:
+        """
+        Body of POST request decoded from JSON, parsed on first use
+        """
+        if self._post_input is None:
+            self._post_input = {}
+            if self.method == "POST":
+                input_len = int(self.environ.get('CONTENT_LENGTH') or 0)
+                self._post_input = json.loads(self.environ['wsgi.input'].read(input_len).decode() or "{}")
+        return self._post_input
+
+    @property
+    def cache_key(self) -> str:
+        """
+        Key identifying response to this request in response cache
+        """
+        return f"{self.path}?{self.environ.get('QUERY_STRING', '')}|{self.content_type}|{self.serializer}"
+
+
+class Route:
+    def __init__(self, path: str, func: callable, methods: tuple[str, ...], auth: bool, json: bool,
+                 cache: str | None, invalidates: tuple[str, ...], limit: str | None, cost: callable | None,
+                 limit_keys: callable | None):
+        self.path = path
+        self.func = func
+        self.methods = methods
+        self.auth = auth
+        self.json = json
+        self.cache = cache
+        self.invalidates = invalidates
+        self.limit = limit
+        self.cost = cost
+        self.limit_keys = limit_keys
+
+
+class Router:
+    """
+    Registry of application routes. Routes are declared with Router.route decorator
+    and looked up by path in a dictionary. Paths with parameters, e.g. "/users/<name>/articles",
+    are matched with regular expressions when no plain path matches
+    """
+    def __init__(self, cache: ResponseCache | None = None, limiter: LocalRateLimiter | RedisRateLimiter | None = None):
+        """
+        @param cache: cache of responses used by routes declaring cache namespace, None disables caching
+        @param limiter: rate limiter used by routes declaring budget, None disables rate limiting
+        """
+        self.cache = cache
+        self.limiter = limiter
+        self.routes = {}    # path: Route
+        self.patterns = []  # (compiled regular expression, Route) of routes with parameters in the path
+
+    def route(self, path: str, methods: tuple[str, ...] = ("GET",), auth: bool = False,
+              json: bool = False, cache: str | None = None, invalidates: tuple[str, ...] = (),
+              limit: str | None = None, cost: callable | None = None, limit_keys: callable | None = None) -> callable:
+        """
+        Decorator registering function as handler of given path. Decorated function is called
+        with application object and Request, and returns tuple of response in bytes and status in string
+        @param path: path of the endpoint, e.g. "/get_articles", or "/users/<name>/articles" where
+                     <name> matches one segment of the path and is passed in Request.path_params
+        @param methods: HTTP methods allowed in this endpoint
+        @param auth: if True, request needs valid token in Auth header and username is set on Request
+        @param json: if True, route returns JSON and is sent as application/json to clients asking for compact JSON
+        @param cache: namespace of response cache successful responses are cached in, None disables caching.
+                      Streamed responses are cached too, so their size needs to be bounded, e.g. by page size
+        @param invalidates: cache namespaces invalidated after successful request, for routes changing data
+        @param limit: name of budget in RATE_LIMITS every client of the route has, None for unlimited route
+        @param cost: function of Request returning number of tokens the request takes, one token if not given
+        @param limit_keys: function of Request returning further keys with their own buckets of the budget,
+                           e.g. username posted to login, so one account is limited no matter the client address
+        @return: decorator
+        """
+        def decorator(func: callable) -> callable:
+            route = Route(path, func, methods, auth, json, cache, invalidates, limit, cost, limit_keys)
+            self.routes[path] = route
+            if "<" in path:
+                pattern = "".join(f"(?P<{part[1:-1]}>[^/]+)" if part.startswith("<") else re.escape(part)
+                                  for part in re.split(r"(<\w+>)", path))
+                self.patterns.append((re.compile(pattern), route))
+            return func
+        return decorator
+
+    def match(self, path: str) -> (Route | None, dict):
+        """
+        @param path: path of the request
+        @return: tuple of route handling the path (None if there is none) and values of its path parameters
+        """
+        route = self.routes.get(path)
+        if route is not None and "<" not in path:
+            return route, {}
+        for pattern, route in self.patterns:
+            found = pattern.fullmatch(path)
+            if found:
+                return route, found.groupdict()
+        return None, {}
+
+    def route_name(self, path: str) -> str:
+        """
+        Name of route handling the path, used as label of metrics and profiles - paths with parameters
+        are named after their route, and unknown paths are named "other", so they cannot create unlimited labels
+        @param path: path of the request
+        @return: path of the route, e.g. "/users/<name>/articles", or "other"
+        """
+        route, _ = self.match(path)
+        return route.path if route is not None else "other"
+
+    def resolve(self, path: str, method: str) -> (Route, dict):
+        """
+        Finds route handling given request
+        @param path: path of the request
+        @param method: HTTP method of the request
+        @return: tuple of matching route and values of its path parameters
+        """
+        route, params = self.match(path)
+        if route is None:
+            raise ex.NotFoundException(path)
+        if method not in route.methods:
+            raise ex.MethodNotAllowedException(list(route.methods) if len(route.methods) > 1 else route.methods[0])
+        return route, params
+
+    def dispatch(self, app, request: Request) -> (bytes, str):
+        """
+        Authenticates request if route requires it and calls route function
+        @param app: application object passed to route function
+        @param request: request to handle
+        @return: tuple of response in bytes and status in string
+        """
+        route, request.path_params = self.resolve(request.path, request.method)
+        if route.auth:
+            token = request.environ.get('HTTP_AUTH')
+            if not token:
+                raise ex.NotLoggedInException
+            request.username = app.auth.authenticate(token)
+        if route.limit and self.limiter is not None:
+            self.check_limit(route, request)
+        if route.json and request.compact:
+            request.content_type = "application/json; charset=utf-8"
+        if route.cache and self.cache is not None:
+            return self.cached(route, app, request)
+        response, status = route.func(app, request)
+        # 202 Accepted means the change is not written yet, routes returning it invalidate once it is
+        if self.cache is not None and status.startswith(("200", "201")):
+            for namespace in route.invalidates:
+                self.cache.invalidate(namespace)
+        return response, status
+
+    def check_limit(self, route: Route, request: Request) -> None:
+        """
+        Takes tokens from the bucket of the client - logged in user, or IP address on routes without login,
+        and from buckets of keys given by the route. Raises TooManyRequestsException with Retry-After header set
+        if the client exceeded budget of the route
+        @return: None
+        """
+        rate, burst = RATE_LIMITS[route.limit]
+        # request costing more than the whole bucket would never pass, it takes the whole bucket instead
+        cost = min(route.cost(request), burst) if route.cost is not None else 1
+        clients = [request.username or request.client_ip]
+        if route.limit_keys is not None:
+            clients += [f"key:{key}" for key in route.limit_keys(request)]
+        for client in clients:
+            wait = self.limiter.take(f"{route.limit}:{client}", rate, burst, cost)
+            if wait > 0:
+                RATE_LIMITED.inc(budget=route.limit)
+                request.response_headers.append(("Retry-After", str(math.ceil(wait))))
+                raise ex.TooManyRequestsException("Too many requests, try again later")
+
+    def cached(self, route: Route, app, request: Request) -> (bytes, str):
+        """
+        Serves response from cache, calling route function only on cache miss. Response carries ETag,
+        and client already having the current version gets empty 304 Not Modified. Streamed response
+        is still streamed on cache miss and cached once it is fully sent, so its ETag comes with the next request
+        @return: tuple of response in bytes (or iterator of chunks on cache miss) and status in string
+        """
+        entry_key = self.cache.entry_key(route.cache, request.cache_key)
+        entry = self.cache.get(entry_key)
+        if entry is None:
+            response, status = route.func(app, request)
+            if status != HTTP_STATUS[200]:
+                return response, status
+            if not isinstance(response, bytes):
+                return self._caching_stream(entry_key, response), status
+            body = response
+            etag = self.cache.set(entry_key, body)
+        else:
+            body, etag = entry
+
+        request.response_headers.append(("ETag", etag))
+        if etag in request.environ.get('HTTP_IF_NONE_MATCH', ''):
+            return b"", HTTP_STATUS[304]
+        return body, HTTP_STATUS[200]
+
+    def _caching_stream(self, entry_key: str, chunks):
+        """
+        Passes chunks of streamed response on as they are produced, and caches the body once all are sent.
+        Body that failed halfway is not cached. Entry key was taken before the body was made, so body made
+        while the namespace was invalidated is stored under old generation and never served
+        """
+        sent = []
+        for chunk in chunks:
+            sent.append(chunk)
+            yield chunk
+        self.cache.set(entry_key, b"".join(sent))
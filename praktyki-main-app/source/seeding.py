@@ -0,0 +1,156 @@
+"""
+Bulk generation of random users, articles and comments for testing.
+
+Usage:  python -m source.seeding users|articles|comments COUNT [--processes N] [--batch SIZE]
+"""
+from __future__ import annotations
+import argparse
+import os
+import random
+from multiprocessing import Pool
+
+from faker import Faker
+
+from source.collections.article_summaries import ArticleSummary
+from source.collections.articles import Article
+from source.collections.comments import Comment
+from source.collections.users import User
+from source.database import Database
+from source.utils import SEED_BATCH_SIZE, SEED_POOL_SIZE, SEED_RANDOM
+
+
+class Seeder:
+    """
+    Generates random documents and inserts them in batches. One Faker instance is reused for all documents,
+    and authors and articles to reference are sampled from the database once, not for every document
+    """
+    _faker = None   # Faker instance shared by all seeders in the process, creating one is slow
+    _seed = SEED_RANDOM     # seed of the process, same data set on every run when set, e.g. for benchmarks
+    _forks = 0      # processes forked so far, gives every forked process its own seed
+
+    def __init__(self, database: Database, batch_size: int = SEED_BATCH_SIZE):
+        self.database = database
+        self.batch_size = batch_size
+        if Seeder._faker is None:
+            Seeder._faker = Faker()
+            if Seeder._seed is not None:
+                Seeder._faker.seed_instance(Seeder._seed)
+        self.fake = Seeder._faker
+        self._authors = None
+        self._article_ids = None
+
+    @staticmethod
+    def reseed(seed) -> None:
+        """
+        Seeds shared Faker instance, random generator shared by other Faker instances and the random module,
+        generated documents depend only on the seed
+        @param seed: int or str
+        @return: None
+        """
+        Seeder._seed = seed
+        if Seeder._faker is not None:
+            Seeder._faker.seed_instance(seed)
+        Faker.seed(seed)
+        random.seed(seed)
+
+    @staticmethod
+    def _count_fork() -> None:
+        Seeder._forks += 1
+
+    @staticmethod
+    def _reseed_after_fork() -> None:
+        """
+        Forked processes (prefork server workers, seeding pool) inherit random state of the parent, without reseeding
+        all of them generate the same users, which collide on unique indexes. Seed derived from SEED_RANDOM
+        and number of the fork keeps data reproducible when workers are started in the same order
+        """
+        if SEED_RANDOM is not None:
+            Seeder.reseed(f"{SEED_RANDOM}-fork{Seeder._forks}")
+        else:
+            Seeder.reseed(random.SystemRandom().getrandbits(64))
+
+    def _authors_pool(self, count: int) -> list[dict]:
+        if self._authors is None:
+            self._authors = self.database.sample("users", min(count, SEED_POOL_SIZE), User.author_fields)
+            if not self._authors:
+                raise ValueError("There are no users to write as")
+        return self._authors
+
+    def _articles_pool(self, count: int) -> list:
+        if self._article_ids is None:
+            articles = self.database.sample("articles", min(count, SEED_POOL_SIZE), Article.id_field)
+            if not articles:
+                raise ValueError("There are no articles to comment")
+            self._article_ids = [article["_id"] for article in articles]
+        return self._article_ids
+
+    def _insert(self, collection_name: str, create: callable, count: int, written: callable = None) -> int:
+        """
+        Inserts count documents made by create() in batches of batch_size
+        @param written: optional function called with documents of every batch that were inserted
+        @return: number of inserted documents, lower than count if some were rejected (e.g. duplicated usernames)
+        """
+        inserted = 0
+        while count > 0:
+            batch = [create() for _ in range(min(count, self.batch_size))]
+            batch_inserted = self.database.insert_many(collection_name, batch, ordered=False)
+            inserted += len(batch_inserted)
+            if written is not None and batch_inserted:
+                written(batch_inserted)
+            count -= len(batch)
+        return inserted
+
+    def users(self, count: int) -> int:
+        return self._insert("users", lambda: User.add_random_user(self.fake).json, count)
+
+    def articles(self, count: int) -> int:
+        authors = self._authors_pool(count)
+        return self._insert("articles", lambda: Article.create_random_article(
+            self.database, self.fake, random.choice(authors)).json, count,
+            lambda batch: ArticleSummary.add(self.database, batch))
+
+    def comments(self, count: int) -> int:
+        authors = self._authors_pool(count)
+        article_ids = self._articles_pool(count)
+        return self._insert("comments", lambda: Comment.create_random_comment(
+            self.database, self.fake, random.choice(authors), random.choice(article_ids)).json, count,
+            lambda batch: ArticleSummary.count_comments(self.database, batch))
+
+
+os.register_at_fork(before=Seeder._count_fork, after_in_child=Seeder._reseed_after_fork)
+
+
+def _seed_in_process(kind: str, count: int, batch_size: int, worker_seed: str | None = None) -> int:
+    if worker_seed is not None:
+        # seed of the share, so the data set does not depend on which pool worker runs it
+        Seeder.reseed(worker_seed)
+    return getattr(Seeder(Database.shared(), batch_size), kind)(count)
+
+
+def seed(kind: str, count: int, processes: int = 1, batch_size: int = SEED_BATCH_SIZE) -> int:
+    """
+    Inserts count random documents of given kind, optionally splitting work between processes
+    @param kind: "users", "articles" or "comments"
+    @param count: number of documents to generate
+    @param processes: number of processes generating documents at the same time
+    @param batch_size: number of documents inserted with one request
+    @return: number of inserted documents
+    """
+    if processes <= 1:
+        return _seed_in_process(kind, count, batch_size)
+    shares = [count // processes + (1 if i < count % processes else 0) for i in range(processes)]
+    # every share gets its own seed, derived from SEED_RANDOM when set, so the whole data set stays reproducible
+    base = SEED_RANDOM if SEED_RANDOM is not None else str(random.SystemRandom().getrandbits(64))
+    tasks = [(kind, share, batch_size, f"{base}-{index}") for index, share in enumerate(shares) if share]
+    with Pool(processes) as pool:
+        return sum(pool.starmap(_seed_in_process, tasks))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Insert random documents into the database")
+    parser.add_argument("kind", choices=("users", "articles", "comments"))
+    parser.add_argument("count", type=int)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--batch", type=int, default=SEED_BATCH_SIZE)
+    args = parser.parse_args()
+    print(f"Inserted {seed(args.kind, args.count, args.processes, args.batch)} {args.kind}")
@@ -0,0 +1,150 @@
+from __future__ import annotations
+import base64
+import datetime
+import textwrap
+from typing import Iterator, Iterable
+
+from bson import Binary, ObjectId
+from bson.json_util import dumps
+
+from source.utils import JSON_INDENT, JSON_SEPARATORS, JSON_BACKEND, STREAM_CHUNK_SIZE
+
+try:
+    import orjson
+except ImportError:     # orjson is optional, BsonSerializer is used without it
+    orjson = None
+
+
+class BsonSerializer:
+    """
+    Serializer using bson.json_util - slow, but understands every BSON type
+    """
+    name = "bson"
+
+    def dumps(self, data: dict | list[dict], compact: bool = False) -> str:
+        if compact:
+            return dumps(data, separators=(',', ':'))
+        return dumps(data, sort_keys=True, indent=JSON_INDENT, separators=JSON_SEPARATORS)
+
+
+class OrjsonSerializer:
+    """
+    Serializer using orjson, several times faster than bson.json_util. BSON types used by the application
+    are written in the same relaxed extended JSON format bson.json_util produces. Unlike bson.json_util,
+    non-ASCII characters are written as UTF-8 instead of \\u escapes, responses declare charset=utf-8
+    """
+    name = "orjson"
+    _epoch = datetime.datetime(1970, 1, 1)
+
+    @staticmethod
+    def _default(value):
+        if isinstance(value, ObjectId):
+            return {"$oid": str(value)}
+        if isinstance(value, datetime.datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            if value < OrjsonSerializer._epoch:
+                # relaxed format has ISO dates only since 1970, earlier ones are milliseconds like in bson.json_util
+                delta = value - OrjsonSerializer._epoch
+                millis = delta.days * 86400000 + delta.seconds * 1000 + delta.microseconds // 1000
+                return {"$date": {"$numberLong": str(millis)}}
+            millis = value.microsecond // 1000
+            fraction = f".{millis:03d}" if millis else ""
+            return {"$date": f"{value.strftime('%Y-%m-%dT%H:%M:%S')}{fraction}Z"}
+        if isinstance(value, bytes):
+            subtype = value.subtype if isinstance(value, Binary) else 0
+            return {"$binary": {"base64": base64.b64encode(value).decode(), "subType": f"{subtype:02x}"}}
+        raise TypeError(f"Type {type(value).__name__} is not JSON serializable")
+
+    def dumps(self, data: dict | list[dict], compact: bool = False) -> str:
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if not compact:
+            option |= orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+        return orjson.dumps(data, default=self._default, option=option).decode()
+
+
+SERIALIZERS = {BsonSerializer.name: BsonSerializer()}
+if orjson is not None:
+    SERIALIZERS[OrjsonSerializer.name] = OrjsonSerializer()
+
+
+def get_serializer(name: str | None = None) -> BsonSerializer | OrjsonSerializer:
+    """
+    Returns serializer with given name, or the configured one. Unknown or unavailable names fall back
+    to the fastest available serializer
+    @param name: name of serializer, e.g. "bson" or "orjson", None for the one set in JSON_BACKEND
+    @return: serializer object
+    """
+    name = name or JSON_BACKEND
+    if name in SERIALIZERS:
+        return SERIALIZERS[name]
+    return SERIALIZERS.get(OrjsonSerializer.name, SERIALIZERS[BsonSerializer.name])
+
+
+def jsonify(dictionary: dict | list[dict], compact: bool = False, serializer: str | None = None) -> str:
+    """
+    Serializes documents to JSON, readable for humans or compact (no indents, keys in stored order) for API clients
+    @param dictionary: documents to serialize
+    @param compact: compact instead of readable JSON
+    @param serializer: name of serializer to use, None for the configured one
+    @return: JSON string
+    """
+    return get_serializer(serializer).dumps(dictionary, compact)
+
+
+def json_response(dictionary: dict | list[dict], compact: bool = False, serializer: str | None = None) -> bytes:
+    """
+    Encodes documents as response body - compact JSON, or readable JSON wrapped in <pre> for browsers
+    """
+    if compact:
+        return jsonify(dictionary, True, serializer).encode()
+    return f"<pre>{jsonify(dictionary, False, serializer)}</pre>".encode()
+
+
+def json_page_stream(records: Iterable[dict], limit: int, compact: bool = False,
+                     serializer: str | None = None, cursor: callable = None) -> Iterator[bytes]:
+    """
+    Encodes one page of a listing as {"items": [...], "next": cursor} chunk by chunk, while records are read
+    from the database cursor, so the whole page is never held in memory. Cursor for the next page is
+    _id of the last record, or null if the page was not full
+    @param records: records on the page, usually a database cursor
+    @param limit: requested page size
+    @param compact: compact JSON instead of readable JSON wrapped in <pre>
+    @param serializer: name of serializer to use, None for the configured one
+    @param cursor: function making cursor of the next page from the last record, instead of its _id
+    @return: generator of encoded chunks of the response body
+    """
+    records = iter(records)
+    first = next(records, None)     # runs the query now, so its errors are reported before the response starts
+    return _page_chunks(first, records, limit, compact, get_serializer(serializer),
+                        cursor or (lambda record: str(record["_id"])))
+
+
+def _page_chunks(record: dict | None, records: Iterator[dict], limit: int, compact: bool,
+                 serializer: BsonSerializer | OrjsonSerializer, cursor: callable) -> Iterator[bytes]:
+    if compact:
+        opening, indent, separator, closing = '{"items":[', '', ',', '],"next":'
+    else:
+        opening, indent, separator, closing = '<pre>{\n  "items": [', '\n', ',\n', '\n  ],\n  "next": '
+    buffer = [opening]
+    size = 0
+    last = None
+    count = 0
+    while record is not None:
+        text = serializer.dumps(record, compact)
+        if not compact:
+            text = textwrap.indent(text, "    ")
+        buffer.append((separator if count else indent) + text)
+        size += len(text)
+        count += 1
+        last = record
+        if size >= STREAM_CHUNK_SIZE:
+            yield "".join(buffer).encode()
+            buffer, size = [], 0
+        record = next(records, None)
+
+    if count == 0 and not compact:
+        closing = '],\n  "next": '
+    next_cursor = f'"{cursor(last)}"' if last is not None and count == limit else "null"
+    buffer.append(closing + next_cursor + ("}" if compact else "\n}</pre>"))
+    yield "".join(buffer).encode()
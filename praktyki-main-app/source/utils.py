@@ -1,8 +1,13 @@
-from bson.json_util import dumps
+import datetime
+import os
+
+from bson import ObjectId
+from bson.errors import InvalidId
 
 HTTP_STATUS = {
     200: "200 OK",
     201: "201 Created",
+    202: "202 Accepted",
     204: "204 No content",
     303: "303 See Other",
     304: "304 Not Modified",
@@ -12,17 +17,194 @@ HTTP_STATUS = {
     404: "404 Not Found",
     405: "405 Method Not Allowed",
     422: "422 Unprocessable Entity",
+    429: "429 Too Many Requests",
     500: "500 Internal Server Error",
     501: "501 Not implemented",
+    503: "503 Service Unavailable",
 }
 
 JSON_INDENT = 2     # how big are indents in generated JSON files
 JSON_SEPARATORS = (',', ': ')   # separators in generated JSON files
+JSON_BACKEND = os.environ.get("JSON_BACKEND", "orjson")     # serializer used by default, "orjson" or "bson"
 
 REGEX_EMAIL = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b'  # regex for recognizing email
 HASH_ITERS = 100000     # number of iterations of hashing function - 100000 results in ~ 10 ms delay
+# Versions of password hashing parameters - version: (hash function, number of iterations).
+# Every user has version of their hash stored, so new version can be added without breaking existing accounts,
+# users are moved to HASH_VERSION on their next login
+HASH_VERSIONS = {
+    1: ("sha512", HASH_ITERS),
+}
+HASH_VERSION = 1    # version used for new passwords
+SERVER_THREADS = int(os.environ.get("SERVER_THREADS", 16))  # request threads per process of threaded and prefork server
+SERVER_BACKLOG = int(os.environ.get("SERVER_BACKLOG", 1024))    # connections waiting to be accepted by the server
+# hashing admits at most HASH_WORKERS + HASH_QUEUE_SIZE requests, it has to stay below the number of request threads,
+# so a burst of logins is rejected with 429 instead of taking all of them (checked when source.hashing is imported)
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", max(1, min(os.cpu_count() or 1, SERVER_THREADS // 4))))
+HASH_QUEUE_SIZE = int(os.environ.get("HASH_QUEUE_SIZE", HASH_WORKERS))  # hashing requests waiting for a free worker
+
+TOKEN_LIFETIME = datetime.timedelta(hours=8)   # how long login token stays valid
+TOKEN_CACHE_SIZE = 10000    # how many verified login tokens are kept in memory
+KEY_CHECK_INTERVAL = 5      # how often (in seconds) RSA key files are checked for changes
+
+AUTHOR_CACHE_SIZE = 10000   # how many author stubs of users are kept in memory
+AUTHOR_CACHE_TTL = 300      # seconds author stub is kept before it is read from database again
+
+PAGE_LIMIT = 50     # default number of entries on one page of a listing
+PAGE_LIMIT_MAX = 500    # maximum number of entries client can request on one page
+SEARCH_QUERY_MAX = 256  # maximum length of full-text search query
+SEARCH_SKIP_MAX = 1000  # deepest search result client can page to, skipped results are still scored by database
+SEARCH_SNIPPET_LENGTH = 200     # characters of article text shown around the first match
+SUMMARY_BATCH_SIZE = 1000   # articles whose summaries are recomputed at once when article_summaries is rebuilt
+
+# Cache of responses of read endpoints, invalidated when data they show changes
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "local")    # "local" - every process on its own, "redis" - shared
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL", "redis://localhost:6379/0")
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1000))     # responses kept by local backend
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 30))       # seconds response can be served from cache
+
+# Rate limiting, see source.ratelimit
+RATE_LIMIT = os.environ.get("RATE_LIMIT", "1") == "1"   # set to 0 to disable, e.g. for benchmarks
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "local")  # "local" - per process, "redis" - shared
+RATE_LIMIT_SHARDS = 16      # independently locked parts of local rate limiter
+RATE_LIMIT_KEYS = 10000     # clients remembered by one shard of local rate limiter
+RATE_LIMIT_TRUST_PROXY = os.environ.get("RATE_LIMIT_TRUST_PROXY", "0") == "1"  # client IP from X-Forwarded-For
+
+
+def _rate_limit(name: str, default: str) -> (float, float):
+    """
+    Reads budget from RATE_LIMIT_<NAME> setting, e.g. "0.5,10", so mistakes are found when the application starts
+    @return: tuple of tokens added per second and capacity of the bucket
+    """
+    setting = os.environ.get(f"RATE_LIMIT_{name.upper()}", default)
+    budget = tuple(float(value) for value in setting.split(","))
+    if len(budget) != 2 or budget[0] <= 0 or budget[1] < 1:
+        raise ValueError(f"RATE_LIMIT_{name.upper()} needs to be \"rate,burst\" with rate > 0 and burst >= 1, "
+                         f"not \"{setting}\"")
+    return budget
+
+
+# budget name: (tokens per second, burst), "RATE_LIMIT_LOGIN=0.5,10" overrides budget "login"
+RATE_LIMITS = {
+    name: _rate_limit(name, default)
+    for name, default in {
+        "login": "0.2,5",   # login, registration and password reset - every one hashes a password
+        "seed": "500,10000",    # inserting random documents - one token per inserted document
+        "write": "2,20",    # articles and comments of logged in users
+    }.items()
+}
+
+STREAM_CHUNK_SIZE = 64 * 1024   # streamed responses are sent in chunks of about this many bytes
+
+# Write-behind buffer of comments - comments are inserted in batches instead of one by one
+COMMENT_BUFFER = os.environ.get("COMMENT_BUFFER", "0") == "1"   # if True, add_comment goes through the buffer
+COMMENT_BUFFER_ACK = os.environ.get("COMMENT_BUFFER_ACK", "1") == "1"   # wait until comment is written by default
+WRITE_BUFFER_SIZE = int(os.environ.get("WRITE_BUFFER_SIZE", 100))   # objects written with one insert_many
+WRITE_BUFFER_INTERVAL = float(os.environ.get("WRITE_BUFFER_INTERVAL", 0.05))    # max seconds object waits in buffer
+WRITE_BUFFER_ACK_TIMEOUT = 10   # seconds request waits for acknowledgement of buffered write
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_QUEUE_SIZE = 10000  # log records waiting to be written, more are dropped instead of blocking requests
+LOG_SUCCESS_SAMPLE_RATE = float(os.environ.get("LOG_SUCCESS_SAMPLE_RATE", 0.01))   # fraction of 2xx/3xx logged
+
+# Profiling of sampled requests, see source.profiling
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))   # fraction of requests profiled, 0 disables
+PROFILE_ALLOW_HEADER = os.environ.get("PROFILE_ALLOW_HEADER", "0") == "1"   # allow "X-Profile: 1" request header
+PROFILE_MODE = os.environ.get("PROFILE_MODE", "cprofile")   # "cprofile" - .prof files, "stacks" - flame graph stacks
+PROFILE_INTERVAL = 0.001    # seconds between stack samples in "stacks" mode
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+SEED_BATCH_SIZE = 1000  # random documents inserted with one request while seeding
+SEED_POOL_SIZE = 1000   # users and articles sampled once to be referenced by seeded documents
+SEED_MAX_COUNT = 10000  # maximum number of random documents inserted by one HTTP request
+SEED_RANDOM = os.environ.get("SEED_RANDOM")  # seed of generated data, set for reproducible data sets
+
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", 32))   # threads running blocking handlers under ASGI server
+
+# MongoDB connection pool, shared by all requests handled by one process
+# MONGO_URI selects the server, e.g. mongodb://localhost:27017 or mongomock:// for in-memory stand-in,
+# when it is not set the Atlas cluster from mongodb-login file is used
+MONGO_URI = os.environ.get("MONGO_URI")
+DATABASE_NAME = os.environ.get("DATABASE_NAME", "praktyki_app_db")
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 50))    # max open connections per process
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))     # connections kept open when idle
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", 300000))  # idle connection is closed after
+MONGO_HEARTBEAT_MS = int(os.environ.get("MONGO_HEARTBEAT_MS", 10000))   # how often driver checks server health
+MONGO_TIMEOUT_MS = int(os.environ.get("MONGO_TIMEOUT_MS", 5000))    # server selection and connect timeout
+
+
+def page_params(get_input: dict) -> (int, ObjectId | None):
+    """
+    Reads pagination parameters from the query string
+    @param get_input: parsed query string, dict of key: list of values
+    @return: tuple of page size and _id after which the page starts (None for the first page)
+    """
+    limit = int(get_input["limit"][0]) if "limit" in get_input else PAGE_LIMIT
+    if not 0 < limit <= PAGE_LIMIT_MAX:
+        raise ValueError(f"Limit needs to be between 1 and {PAGE_LIMIT_MAX}")
+    after = None
+    if "after" in get_input:
+        try:
+            after = ObjectId(get_input["after"][0])
+        except InvalidId:
+            raise ValueError("Invalid page cursor")
+    return limit, after
+
+
+def feed_params(get_input: dict) -> (int, tuple[datetime.datetime, ObjectId] | None):
+    """
+    Reads pagination parameters of listings ordered by date from the query string.
+    Cursor is "date|_id" of the last entry of previous page, e.g. "2024-05-20T10:15:00.123000|6650...",
+    as given in "next" of the previous page
+    @param get_input: parsed query string, dict of key: list of values
+    @return: tuple of page size and (date, _id) after which the page starts (None for the first page)
+    """
+    limit = int(get_input["limit"][0]) if "limit" in get_input else PAGE_LIMIT
+    if not 0 < limit <= PAGE_LIMIT_MAX:
+        raise ValueError(f"Limit needs to be between 1 and {PAGE_LIMIT_MAX}")
+    after = None
+    if "after" in get_input:
+        date, _, object_id = get_input["after"][0].partition("|")
+        try:
+            after = datetime.datetime.fromisoformat(date), ObjectId(object_id)
+        except (ValueError, InvalidId):
+            raise ValueError("Invalid page cursor")
+    return limit, after
+
+
+def feed_cursor(entry: dict) -> str:
+    """
+    @param entry: last entry of a page of listing ordered by date
+    @return: cursor of the next page, read by feed_params
+    """
+    return f"{entry['date_created'].isoformat()}|{entry['_id']}"
+
 
+def search_params(get_input: dict) -> (str, int, int):
+    """
+    Reads full-text search parameters from the query string
+    @param get_input: parsed query string, dict of key: list of values
+    @return: tuple of search query, page size and number of results to skip
+    """
+    query = get_input["q"][0].strip() if "q" in get_input else ""
+    if not 0 < len(query) <= SEARCH_QUERY_MAX:
+        raise ValueError(f"Search query needs to be between 1 and {SEARCH_QUERY_MAX} characters long")
+    limit = int(get_input["limit"][0]) if "limit" in get_input else PAGE_LIMIT
+    if not 0 < limit <= PAGE_LIMIT_MAX:
+        raise ValueError(f"Limit needs to be between 1 and {PAGE_LIMIT_MAX}")
+    skip = int(get_input["skip"][0]) if "skip" in get_input else 0
+    if not 0 <= skip <= SEARCH_SKIP_MAX:
+        raise ValueError(f"Skip needs to be between 0 and {SEARCH_SKIP_MAX}")
+    return query, limit, skip
 
-def jsonify(dictionary: dict | list[dict]) -> str:
-    return dumps(dictionary, sort_keys=True, indent=JSON_INDENT, separators=JSON_SEPARATORS)
 
+def seed_count(get_input: dict) -> int:
+    """
+    Reads number of random documents to insert from the query string
+    @param get_input: parsed query string, dict of key: list of values
+    @return: number of documents, 1 if not given
+    """
+    count = int(get_input["count"][0]) if "count" in get_input else 1
+    if not 0 < count <= SEED_MAX_COUNT:
+        raise ValueError(f"Count needs to be between 1 and {SEED_MAX_COUNT}")
+    return count